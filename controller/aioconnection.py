@@ -0,0 +1,327 @@
+# This module handles the connection with a robot from asyncio, without gevent
+
+import os
+import asyncio
+from protocol import (DEFAULT_PORTS, BAUD_RATE, RX_BUFFER, MISC_COMMAND, MISC_GET_FEATURES, LinkModel, FrameParser,
+	Handshake, Upload, ports_to_probe, save_last_port, encode)
+from transport import Transport, open_transport
+
+
+class AsyncTransport(asyncio.Transport):
+	"""
+		Asyncio transport for a link opened by open_transport (serial port, socket or emulator), that reads
+		and writes its file descriptor from the event loop without blocking
+	"""
+
+	def __init__ (self, loop, protocol, conn):
+		super().__init__()
+		self._loop = loop
+		self._protocol = protocol
+		self._conn = conn
+		self._fd = conn.fileno()
+		self._buffer = bytearray()
+		self._closing = False
+		self._lost = False
+		os.set_blocking(self._fd, False)
+		self._loop.add_reader(self._fd, self._read_ready)
+		self._loop.call_soon(self._protocol.connection_made, self)
+
+	def get_extra_info (self, name, default = None):
+		return self._conn if name == 'transport' else default
+
+	def set_protocol (self, protocol):
+		self._protocol = protocol
+
+	def get_protocol (self):
+		return self._protocol
+
+	def is_closing (self):
+		return self._closing
+
+	def get_write_buffer_size (self):
+		return len(self._buffer)
+
+	def write (self, data):
+		if self._closing:
+			return
+		if not self._buffer:
+			try:
+				written = os.write(self._fd, data)
+			except BlockingIOError:
+				written = 0
+			except OSError as e:
+				self._fatal_error(e)
+				return
+			data = data[written:]
+			if not data:
+				return
+			self._loop.add_writer(self._fd, self._write_ready)
+		self._buffer.extend(data)
+
+	def close (self):
+		if self._closing:
+			return
+		self._closing = True
+		self._loop.remove_reader(self._fd)
+		if not self._buffer:
+			self._loop.call_soon(self._call_connection_lost, None)
+
+	def abort (self):
+		self._fatal_error(None)
+
+	def _read_ready (self):
+		try:
+			data = os.read(self._fd, 4096)
+		except BlockingIOError:
+			return
+		except OSError as e:
+			self._fatal_error(e)
+			return
+		if data:
+			self._protocol.data_received(data)
+		else:
+			self._fatal_error(None)
+
+	def _write_ready (self):
+		try:
+			written = os.write(self._fd, self._buffer)
+		except BlockingIOError:
+			return
+		except OSError as e:
+			self._fatal_error(e)
+			return
+		del self._buffer[:written]
+		if not self._buffer:
+			self._loop.remove_writer(self._fd)
+			if self._closing:
+				self._call_connection_lost(None)
+
+	def _fatal_error (self, exc):
+		self._buffer.clear()
+		self._loop.remove_writer(self._fd)
+		self._loop.remove_reader(self._fd)
+		self._closing = True
+		self._loop.call_soon(self._call_connection_lost, exc)
+
+	def _call_connection_lost (self, exc):
+		if self._lost:
+			return
+		self._lost = True
+		try:
+			self._protocol.connection_lost(exc)
+		finally:
+			self._conn.close()
+
+
+async def create_connection (loop, protocol_factory, url, baudrate = BAUD_RATE):
+	"""
+		Opens the link given by a device or URL and returns (transport, protocol), as loop.create_connection() does
+	"""
+	conn = open_transport(url, baudrate)
+	protocol = protocol_factory()
+	return AsyncTransport(loop, protocol, conn), protocol
+
+
+class _Handshake(asyncio.Protocol):
+	"""
+		Waits for a robot to answer the positions of its channels while probing a port
+	"""
+
+	def __init__ (self):
+		self.handshake = Handshake()
+		self.answered = asyncio.get_running_loop().create_future()
+
+	def data_received (self, data):
+		if self.handshake.feed(data) and not self.answered.done():
+			self.answered.set_result(True)
+
+	def connection_lost (self, exc):
+		if not self.answered.done():
+			self.answered.set_result(False)
+
+
+class AsyncRobotConnection(asyncio.Protocol):
+	"""
+		Same as RobotConnection, for asyncio. Methods that wait for the robot are coroutines
+	"""
+
+	DEFAULT_PORTS = DEFAULT_PORTS
+	BAUD_RATE = BAUD_RATE
+	CHUNK_SIZE = RX_BUFFER // 2
+	LAST_PORTS = 'ports.conf'
+	HANDSHAKE_TIMEOUT = 4.0
+	HANDSHAKE_INTERVAL = 0.5
+
+	def __init__ (self, ports = None, name = ''):
+		self.name = name
+		self.device = None
+		self._transport = None
+		self._parser = FrameParser()
+		self._frames = asyncio.Queue()
+		self._raw = None
+		self._features = None
+		self._link = LinkModel(baud_rate = self.BAUD_RATE)
+		self.upload_stats = None
+		if isinstance(ports, (str, Transport)):
+			ports = [ports]
+		self.ports = ports or self.DEFAULT_PORTS
+
+	async def connect (self):
+		if self.is_connected():
+			return
+		self._features = None
+
+		# Try first where the robot was found last time, then every other port at the same time
+		for devices in ports_to_probe(self.name, self.ports, self.LAST_PORTS):
+			found = await self._probe_all(devices)
+			if found:
+				break
+
+		if found:
+			self.device, self._transport, self._parser = found
+			print("Connected by ", self.device)
+			if isinstance(self.device, str):
+				save_last_port(self.name, self.device, self.LAST_PORTS)
+			# Replies to the reads that found the robot may come yet, so the parser goes on from where the probe was
+			self._transport.set_protocol(self)
+			await self.get_features()
+			while not self._frames.empty():
+				self._frames.get_nowait()
+
+	def is_connected (self):
+		return self._transport is not None and not self._transport.is_closing()
+
+	def close (self):
+		if self._transport:
+			self._transport.close()
+			self._transport = None
+
+	async def _probe_all (self, devices):
+		probes = [asyncio.ensure_future(self._probe(device)) for device in devices]
+		try:
+			for probe in asyncio.as_completed(probes):
+				found = await probe
+				if found:
+					return found
+		finally:
+			for probe in probes:
+				probe.cancel()
+		return None
+
+	async def _probe (self, device):
+		loop = asyncio.get_running_loop()
+		try:
+			transport, handshake = await create_connection(loop, _Handshake, device, self.BAUD_RATE)
+		except (ValueError, IOError):
+			return None
+		deadline = loop.time() + self.HANDSHAKE_TIMEOUT
+		try:
+			while loop.time() < deadline:
+				transport.write(Handshake.REQUEST)
+				try:
+					if await asyncio.wait_for(asyncio.shield(handshake.answered), self.HANDSHAKE_INTERVAL):
+						found, transport = transport, None
+						return device, found, handshake.handshake.parser
+					break
+				except asyncio.TimeoutError:
+					pass
+		finally:
+			if transport:
+				transport.close()
+		return None
+
+	def data_received (self, data):
+		if self._raw is not None:
+			# Telemetry frames sent before the upload started may come yet
+			data = self._parser.strip(data)
+			if data:
+				self._raw.put_nowait(data)
+		else:
+			for frame in self._parser.feed(data):
+				self._frames.put_nowait(frame)
+
+	def connection_lost (self, exc):
+		if exc:
+			print("Error reading", exc)
+		self._transport = None
+
+	async def recv (self, timeout = 2.0):
+		"""
+			Waits for the next reply from the robot, and returns its content without the length
+		"""
+		try:
+			return await asyncio.wait_for(self._frames.get(), timeout)
+		except asyncio.TimeoutError:
+			print("Receiving timeout...")
+			self._parser.reset()
+			return None
+
+	async def send (self, cmd, params):
+		return await self.write(encode(cmd, params))
+
+	async def write (self, data):
+		"""
+			Same as send, for several commands already encoded, written at once
+		"""
+		await self._write_paced(data, self._link)
+		return True
+
+	async def get_features (self):
+		if self._features is None:
+			await self.send(MISC_COMMAND, MISC_GET_FEATURES)
+			reply = await self.recv(timeout = 0.5)
+			# Whole frames before the reply to the features are dropped
+			while reply is not None and len(reply) != 1:
+				reply = await self.recv(timeout = 0.5)
+			self._features = reply[0] if reply else 0
+		return self._features
+
+	async def upload (self, data, timeout = 2.0):
+		"""
+			Same as RobotConnection.upload
+		"""
+		loop = asyncio.get_running_loop()
+		upload = Upload(data, await self.get_features(), self.BAUD_RATE)
+		start = loop.time()
+		if upload.mode == 'credits':
+			done = await self._upload_with_credits(upload, timeout)
+		else:
+			await self._write_paced(upload.data, upload.link)
+			# Wait until the firmware should have stored everything
+			await asyncio.sleep(upload.link.drain_time(loop.time()))
+			done = True
+		elapsed = loop.time() - start
+		if not done:
+			print("Upload timeout...")
+			return None
+		self.upload_stats = upload.stats(elapsed)
+		return self.upload_stats['rate']
+
+	async def _upload_with_credits (self, upload, timeout):
+		self._raw = asyncio.Queue()
+		try:
+			while True:
+				chunk = upload.allowed()
+				if chunk:
+					self._get_transport().write(chunk)
+				try:
+					done = upload.received(await asyncio.wait_for(self._raw.get(), timeout))
+				except asyncio.TimeoutError:
+					return False
+				if done is not None:
+					return done
+		finally:
+			self._raw = None
+
+	async def _write_paced (self, data, link):
+		loop = asyncio.get_running_loop()
+		for start in range(0, len(data), self.CHUNK_SIZE):
+			chunk = data[start:start + self.CHUNK_SIZE]
+			await asyncio.sleep(link.wait_time(len(chunk), loop.time()))
+			self._get_transport().write(chunk)
+			link.add(len(chunk), loop.time())
+
+	def _get_transport (self):
+		if not self.is_connected():
+			raise IOError("Not connected to the robot")
+		return self._transport
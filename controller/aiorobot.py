@@ -0,0 +1,147 @@
+import asyncio
+from collections import deque
+from program import RobotProgram
+from robotbase import RobotBase
+from aioconnection import AsyncRobotConnection
+from protocol import encode
+
+"""
+   Robot interface for asyncio
+"""
+
+class AsyncRobot(RobotBase):
+	"""
+		Same as Robot, for programs running an asyncio loop instead of gevent. connect() has to be awaited
+		before sending commands, and the methods talking to the robot are coroutines that return when the
+		command has been sent (or with the reply, for reads). Only the last command given to a channel is sent,
+		and the ones it replaces return None. The port is given as for Robot
+	"""
+
+	def __init__ (self, prefix='', port=None):
+		RobotBase.__init__(self, prefix)
+		self._conn = AsyncRobotConnection(ports=port, name=self.prefix)
+		# Last command for every channel, and queue for control, misc and other commands, as (cmd, params, future)
+		self._channel_commands = [None for i in AsyncRobot.CHANNELS]
+		self._control_commands = deque()
+		self._wakeup = None
+		self._process_commands = None
+
+	async def connect (self):
+		await self._conn.connect()
+		self._wakeup = asyncio.Event()
+		self._process_commands = asyncio.ensure_future(self._process_commands_loop())
+
+	async def close (self):
+		if self._process_commands:
+			self._process_commands.cancel()
+			self._process_commands = None
+		self._conn.close()
+
+	async def __aenter__ (self):
+		await self.connect()
+		return self
+
+	async def __aexit__ (self, *args):
+		await self.close()
+
+	async def run (self, program):
+		"""
+			Run program 0 means stop, otherwise, starts the execution of the program number given (1-255)
+		"""
+		return await self._request(-1, RobotProgram.CONTROL_COMMAND, program)
+
+	async def stop (self):
+		return await self.run(0)
+
+	async def upload_programs (self, upload_mode = 0):
+		"""
+			Upload all the programs to the robot, in RAM (0) or in EEPROM (1). Returns the throughput achieved
+		"""
+		return await self._request(-1, RobotProgram.MISC_COMMAND, self._get_upload_code(upload_mode))
+
+	async def set_position (self, program, step, channel, speed, mode, pos):
+		"""
+			Set the position for a channel
+		"""
+		channel_cmd = self._set_position_command(program, step, channel, speed, mode, pos)
+		if channel_cmd:
+			channel, cmd = channel_cmd
+			return await self._request(channel, cmd, pos)
+
+	async def get_positions (self):
+		positions = await self._request(-1, RobotProgram.MISC_COMMAND, 0)
+		if positions is None:
+			print("Error reading positions")
+		return positions
+
+	async def get_sensors (self):
+		sensors = await self._request(-1, RobotProgram.MISC_COMMAND, 1)
+		if sensors is None:
+			print("Error reading sensors")
+		return sensors
+
+	def _request (self, channel, cmd, params):
+		if self._wakeup is None:
+			raise IOError("Not connected to the robot")
+		future = asyncio.get_running_loop().create_future()
+		if channel == -1:
+			self._control_commands.append((cmd, params, future))
+		else:
+			replaced = self._channel_commands[channel]
+			if replaced and not replaced[2].done():
+				replaced[2].set_result(None)
+			self._channel_commands[channel] = (cmd, params, future)
+		self._wakeup.set()
+		return future
+
+	async def _process_commands_loop (self):
+		"""
+			Sends every last command given to a channel, written at once, and the control commands in order
+		"""
+		while True:
+			await self._wakeup.wait()
+			self._wakeup.clear()
+			while self._control_commands or any(self._channel_commands):
+				commands = [command for command in self._channel_commands if command]
+				if commands:
+					self._channel_commands = [None for i in AsyncRobot.CHANNELS]
+					await self._send([future for cmd, params, future in commands],
+						self._send_channels([(cmd, params) for cmd, params, future in commands]))
+				if self._control_commands:
+					cmd, params, future = self._control_commands.popleft()
+					await self._send([future], self._send_control(cmd, params))
+
+	async def _send (self, futures, sending):
+		try:
+			result = await sending
+		except Exception as e:
+			for future in futures:
+				if not future.done():
+					future.set_exception(e)
+		else:
+			for future in futures:
+				if not future.done():
+					future.set_result(result)
+
+	async def _send_channels (self, commands):
+		# Send commands optionally for legs and trunk, but allow control commands always
+		if self.send_commands_flag:
+			if self.debug_commands_flag:
+				for cmd, params in commands:
+					print("Send", cmd, params)
+			return await self._conn.write(b''.join(encode(cmd, params) for cmd, params in commands))
+		return None
+
+	async def _send_control (self, cmd, params):
+		if cmd in (RobotProgram.CONTROL_COMMAND, RobotProgram.OTHER_COMMAND):
+			return await self._conn.send(cmd, params)
+		elif cmd == RobotProgram.MISC_COMMAND:
+			subcmd = params[0] if isinstance(params, (tuple, list)) else params
+			if subcmd in (0, 1):            # READ POSITIONS or SENSORS
+				await self._conn.send(cmd, subcmd)
+				return await self._conn.recv()
+			elif subcmd == 254:             # LOAD CONFIGURATION FROM EEPROM
+				return await self._conn.send(cmd, subcmd)
+			elif subcmd in (253, 255):      # UPLOAD CONFIGURATION
+				return await self._conn.upload(params)
+		return None
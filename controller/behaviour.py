@@ -0,0 +1,228 @@
+# This module switches the programs running in a robot as its sensors change, from rules evaluated on every sample
+
+from time import monotonic
+from gevent import spawn, sleep
+from gevent.event import AsyncResult
+from protocol import TELEMETRY_INPUTS
+
+"""
+   Rules are conditions on the analog inputs, built from sensor(i) (0-255, as sent by the robot), i.e.:
+      difference = sensor(0) - sensor(1)
+      behaviour = Behaviour(robot)
+      behaviour.when(difference.above(10, release = 5), TURN_RIGHT).when(sensor(0) < 20, STANDING).otherwise(GO_FORWARD)
+      behaviour.start()
+   They are compiled once into plain functions of the values of a telemetry frame when the behaviour starts
+"""
+
+
+class Signal(object):
+	"""
+		Value computed from the analog inputs. compile(columns) returns a function giving it from the values of
+		a frame, where columns are the inputs in the frame
+	"""
+
+	def __init__ (self, compile, inputs = ()):
+		self.compile = compile
+		self.inputs = frozenset(inputs)
+
+	@staticmethod
+	def wrap (value):
+		if isinstance(value, Signal):
+			return value
+		return Signal(lambda columns: lambda values: value)
+
+	def _combine (self, other, operation):
+		other = Signal.wrap(other)
+		def compile (columns):
+			first, second = self.compile(columns), other.compile(columns)
+			return lambda values: operation(first(values), second(values))
+		return Signal(compile, self.inputs | other.inputs)
+
+	def __add__ (self, other):
+		return self._combine(other, lambda a, b: a + b)
+
+	def __sub__ (self, other):
+		return self._combine(other, lambda a, b: a - b)
+
+	def __rsub__ (self, other):
+		return Signal.wrap(other) - self
+
+	def __mul__ (self, other):
+		return self._combine(other, lambda a, b: a * b)
+
+	def __abs__ (self):
+		def compile (columns):
+			function = self.compile(columns)
+			return lambda values: abs(function(values))
+		return Signal(compile, self.inputs)
+
+	def _compare (self, other, operation):
+		other = Signal.wrap(other)
+		def compile (columns):
+			first, second = self.compile(columns), other.compile(columns)
+			return lambda values: operation(first(values), second(values))
+		return Condition(compile, self.inputs | other.inputs)
+
+	def __gt__ (self, other):
+		return self._compare(other, lambda a, b: a > b)
+
+	def __ge__ (self, other):
+		return self._compare(other, lambda a, b: a >= b)
+
+	def __lt__ (self, other):
+		return self._compare(other, lambda a, b: a < b)
+
+	def __le__ (self, other):
+		return self._compare(other, lambda a, b: a <= b)
+
+	def above (self, threshold, release = None):
+		"""
+			True from when it goes over threshold until it goes under release (threshold by default), so it
+			doesn't flap while it's around the threshold
+		"""
+		return self._hysteresis(lambda value, on: value > (threshold if not on or release is None else release))
+
+	def below (self, threshold, release = None):
+		"""
+			Same as above, true from when it goes under threshold until it goes over release
+		"""
+		return self._hysteresis(lambda value, on: value < (threshold if not on or release is None else release))
+
+	def _hysteresis (self, test):
+		def compile (columns):
+			function = self.compile(columns)
+			state = [False]     # Every compiled condition keeps its own
+			def condition (values):
+				state[0] = test(function(values), state[0])
+				return state[0]
+			return condition
+		return Condition(compile, self.inputs)
+
+
+def sensor (i):
+	"""
+		Value of the analog input i (0 for A0)
+	"""
+	def compile (columns):
+		column = columns.index(i)
+		return lambda values: int(values[column])
+	return Signal(compile, [i])
+
+
+class Condition(object):
+	"""
+		Test on the analog inputs, that can be combined with &, | and ~
+	"""
+
+	def __init__ (self, compile, inputs = ()):
+		self.compile = compile
+		self.inputs = frozenset(inputs)
+
+	def _combine (self, other, operation):
+		def compile (columns):
+			first, second = self.compile(columns), other.compile(columns)
+			# Both are evaluated always, to keep the state of hysteresis
+			return lambda values: operation(first(values), second(values))
+		return Condition(compile, self.inputs | other.inputs)
+
+	def __and__ (self, other):
+		return self._combine(other, lambda a, b: a and b)
+
+	def __or__ (self, other):
+		return self._combine(other, lambda a, b: a or b)
+
+	def __invert__ (self):
+		def compile (columns):
+			function = self.compile(columns)
+			return lambda values: not function(values)
+		return Condition(compile, self.inputs)
+
+
+ALWAYS = Condition(lambda columns: lambda values: True)
+
+
+class Behaviour(object):
+	"""
+		Runs a program in the robot depending on the first of the rules (condition, program) that holds, checked for
+		every sample of the sensors pushed by the robot (rate per second), or read from it if its firmware has no
+		telemetry. A program is only run when a different rule takes over, and the time from the sample until it
+		was sent is the decision latency, printed and kept in the behaviour.decision metric of the robot
+	"""
+
+	def __init__ (self, robot, rate = 50.0):
+		self.robot = robot
+		self.rate = rate
+		self.rules = []             # (name, condition, program)
+		self.active = None          # Name of the rule in control
+		self.decisions = []         # (name, program, decision latency) for every switch
+		self._rules = None
+		self._poller = None         # Greenlet reading the sensors, without telemetry
+
+	def when (self, condition, program, name = None):
+		self.rules.append((name or 'rule %d' % (len(self.rules) + 1), condition, program))
+		return self
+
+	def otherwise (self, program, name = 'otherwise'):
+		return self.when(ALWAYS, program, name)
+
+	def start (self):
+		"""
+			Starts the telemetry of the inputs used by the rules, or reading all of them if the robot can't push
+			them, and follows them from the next sample
+		"""
+		inputs = sorted(set().union(*[condition.inputs for _, condition, _ in self.rules]))
+		if not inputs:
+			raise ValueError("The rules don't use any sensor")
+		self.active = None
+		if self.robot.supports_telemetry():
+			columns = self.robot.start_telemetry(self.rate, inputs).inputs
+			self._rules = [(name, condition.compile(columns), program) for name, condition, program in self.rules]
+			self.robot.subscribe_telemetry(self._sample)
+		else:
+			print("Telemetry is not supported by the robot, reading the sensors instead")
+			columns = list(range(TELEMETRY_INPUTS))
+			self._rules = [(name, condition.compile(columns), program) for name, condition, program in self.rules]
+			self._poller = spawn(self._poll_loop)
+
+	def stop (self, program = None):
+		"""
+			Stops following the sensors and their telemetry, and runs the program given, if any
+		"""
+		if self._poller is not None:
+			self._poller.kill()
+			self._poller = None
+		else:
+			self.robot.unsubscribe_telemetry(self._sample)
+			self.robot.stop_telemetry()
+		if program is not None:
+			self.robot.run(program)
+
+	def _poll_loop (self):
+		"""
+			Reads the sensors rate times per second, at fixed times since it started, so delays don't add up
+		"""
+		period = 1.0 / self.rate
+		next_read = monotonic()
+		while True:
+			values = self.robot.get_sensors()
+			if values is not None and len(values) >= TELEMETRY_INPUTS:
+				self._sample(None, values)
+			next_read = max(next_read + period, monotonic())
+			sleep(next_read - monotonic())
+
+	def _sample (self, time, values):
+		received = monotonic()
+		holds = [(name, program) for name, condition, program in self._rules if condition(values)]
+		name, program = holds[0] if holds else (None, None)
+		if name == self.active:
+			return
+		self.active = name
+		if program is not None:
+			sent = AsyncResult()
+			sent.rawlink(lambda sent: self._decided(name, program, sent.get() - received))
+			self.robot.run(program, sent)
+
+	def _decided (self, name, program, latency):
+		print("Behaviour: %s, running %d (%.1f ms)" % (name, program, latency * 1000))
+		self.robot.metrics.observe('behaviour.decision', latency)
+		self.decisions.append((name, program, latency))
@@ -0,0 +1,167 @@
+# This module records the traffic with a robot to a file, and serves it back as if it came from the robot
+
+import sys
+import time
+import struct
+import socket
+import threading
+from time import monotonic
+from transport import Transport, SocketTransport
+
+"""
+   Capture files start by MAGIC, followed by a record for every write to or read from the robot: microseconds
+   since the previous record (4 bytes), direction (1 byte, SENT or RECEIVED), length (2 bytes) and the bytes.
+   Usage: python3 capture.py session.cap, to list its records
+"""
+
+MAGIC = b'LBCAP\x01'
+SENT = 0
+RECEIVED = 1
+RECORD = struct.Struct('<IBH')
+
+
+class CaptureWriter(object):
+
+	def __init__ (self, path):
+		self.path = path
+		self._file = open(path, 'wb')
+		self._file.write(MAGIC)
+		self._last = None
+
+	def record (self, timestamp, direction, data):
+		"""
+			Adds the bytes sent or received at the monotonic time given
+		"""
+		delta = 0 if self._last is None else min(int((timestamp - self._last) * 1e6), 0xffffffff)
+		self._last = timestamp if self._last is None else self._last + delta / 1e6
+		for start in range(0, len(data), 0xffff):
+			chunk = data[start:start + 0xffff]
+			self._file.write(RECORD.pack(delta, direction, len(chunk)))
+			self._file.write(chunk)
+			delta = 0
+
+	def flush (self):
+		self._file.flush()
+
+	def close (self):
+		self._file.close()
+
+
+def read_capture (path):
+	"""
+		Yields (seconds since the first record, direction, bytes) for every record in a capture file
+	"""
+	with open(path, 'rb') as f:
+		if f.read(len(MAGIC)) != MAGIC:
+			raise ValueError("%s is not a capture file" % path)
+		timestamp = 0.0
+		while True:
+			header = f.read(RECORD.size)
+			if len(header) < RECORD.size:
+				return
+			delta, direction, length = RECORD.unpack(header)
+			timestamp += delta / 1e6
+			yield timestamp, direction, f.read(length)
+
+
+class CaptureTransport(Transport):
+	"""
+		Records every byte written to or read from another transport. Until a writer is attached, records are
+		kept in memory, so the probe of a port is in the capture only if the robot was found there
+	"""
+
+	def __init__ (self, transport, writer = None):
+		self.transport = transport
+		self.url = transport.url
+		self._writer = writer
+		self._records = []
+
+	def attach (self, writer):
+		for record in self._records:
+			writer.record(*record)
+		self._records = []
+		self._writer = writer
+
+	def _record (self, direction, data):
+		if data:
+			if self._writer:
+				self._writer.record(monotonic(), direction, data)
+			else:
+				self._records.append((monotonic(), direction, bytes(data)))
+
+	def write (self, data):
+		self.transport.write(data)
+		self._record(SENT, data)
+
+	def read (self, size = 1):
+		data = self.transport.read(size)
+		self._record(RECEIVED, data)
+		return data
+
+	@property
+	def in_waiting (self):
+		return self.transport.in_waiting
+
+	@property
+	def is_open (self):
+		return self.transport.is_open
+
+	def fileno (self):
+		return self.transport.fileno()
+
+	def flush (self):
+		self.transport.flush()
+
+	def close (self):
+		self.transport.close()
+
+
+class ReplayTransport(SocketTransport):
+	"""
+		Robot that answers as recorded in a capture. The bytes received then are sent once the host has written
+		everything that was sent before them, and as long after it as they came then (divided by speed, or at
+		once if it's 0). Writes that differ from the capture are counted in mismatches
+	"""
+
+	def __init__ (self, path, speed = 1.0):
+		self.speed = speed
+		self.mismatches = 0
+		self._records = list(read_capture(path))
+		host, self._robot = socket.socketpair()
+		threading.Thread(target = self._serve, daemon = True).start()
+		SocketTransport.__init__(self, host, 'replay://%s?speed=%s' % (path, speed))
+
+	def _serve (self):
+		robot = self._robot
+		written = bytearray()
+		anchor = (monotonic(), 0.0)
+		try:
+			for timestamp, direction, data in self._records:
+				if direction == SENT:
+					while len(written) < len(data):
+						chunk = robot.recv(4096)
+						if not chunk:
+							return
+						written.extend(chunk)
+					if written[:len(data)] != data:
+						self.mismatches += 1
+					del written[:len(data)]
+					anchor = (monotonic(), timestamp)
+				else:
+					if self.speed:
+						delay = anchor[0] + (timestamp - anchor[1]) / self.speed - monotonic()
+						if delay > 0:
+							time.sleep(delay)
+					robot.sendall(data)
+			# Keep the link open until the host closes it
+			while robot.recv(4096):
+				pass
+		except OSError:
+			pass
+		finally:
+			robot.close()
+
+
+if __name__ == '__main__':
+	for timestamp, direction, data in read_capture(sys.argv[1]):
+		print("%10.6f %s %s" % (timestamp, '>' if direction == SENT else '<', data.hex(' ')))
@@ -1,114 +1,561 @@
-# This module handles the serial connection with a robot
+# This module handles the connection with a robot, through any of the transports in transport.py
 
 import sys
-import serial
-import struct
-from gevent import sleep, spawn, Timeout
+from time import monotonic
+from collections import deque
+from gevent import sleep, spawn, spawn_later, iwait, killall, getcurrent, Timeout
+from gevent.event import Event, AsyncResult
+from gevent.queue import Queue, Empty
+from gevent.socket import wait_read
+from protocol import (DEFAULT_PORTS, BAUD_RATE, RX_BUFFER, MISC_COMMAND, MISC_GET_POSITIONS, MISC_GET_SENSORS, MISC_GET_FEATURES,
+	MISC_TELEMETRY, FEATURE_TELEMETRY, MAX_OUTPUTS, TELEMETRY_INPUTS, LinkModel, FrameParser, Handshake, Upload, ports_to_probe,
+	save_last_port, encode)
+from transport import Transport, open_transport
+from capture import CaptureWriter, CaptureTransport
+from metrics import Metrics
 
 USE_AUTODETECT = 0
 USE_PYSERIAL = 1
 USE_PYBLUEZ = 2
 USE_ANDROID = 3
 
+# States of the connection, given to the subscribers with the error that caused them, if any
+CONNECTED = 'connected'
+DISCONNECTED = 'disconnected'
+RECONNECTING = 'reconnecting'
+
+# Name of the round trip time of every read, in the metrics
+READ_METRICS = {
+	MISC_GET_POSITIONS: 'rtt.positions',
+	MISC_GET_SENSORS: 'rtt.sensors',
+	MISC_GET_FEATURES: 'rtt.features',
+}
+
+# Values in the reply to every read, when they don't depend on the configuration
+REPLY_LENGTHS = {
+	MISC_GET_SENSORS: TELEMETRY_INPUTS,
+	MISC_GET_FEATURES: 1,
+}
+
+# Transport used for the ports given without scheme, by library
+LIBRARY_SCHEMES = {
+	USE_AUTODETECT: 'serial',
+	USE_PYSERIAL: 'serial',
+	USE_PYBLUEZ: 'bt',
+}
+
+class Reply(AsyncResult):
+	"""
+		Future for the reply to a read, set as soon as it's received, or to None if it doesn't come in time, the
+		connection is lost or the read is cancelled
+	"""
+
+	def __init__ (self, timeout = 2.0, length = None):
+		AsyncResult.__init__(self)
+		self.timeout = timeout
+		self.length = length        # Values expected in the reply, if known
+		self.sent = None            # (subcmd, time it was written)
+		self.received = None        # Time the reply was parsed
+		self.holding = False        # Whether the link is held until the firmware has answered
+
+	def cancel (self):
+		"""
+			Stops waiting for the reply. If the read was sent, the reply is still taken when it comes, and thrown
+			away, not to mistake it for the reply to the next one
+		"""
+		if not self.ready():
+			self.set(None)
+
+
 class RobotConnection(object):
 
-	DEFAULT_PORTS = ["/dev/rfcomm1", "/dev/rfcomm0", "/dev/ttyUSB0", "/dev/ttyUSB1", "/dev/ttyUSB4", "/dev/ttyUSB5"]
-	BAUD_RATE = 57600
-	
-	def __init__ (self, use_library=USE_AUTODETECT):
+	DEFAULT_PORTS = DEFAULT_PORTS
+	BAUD_RATE = BAUD_RATE
+	CHUNK_SIZE = RX_BUFFER // 2
+	LAST_PORTS = 'ports.conf'       # Last port where every robot was found, by name
+	HANDSHAKE_TIMEOUT = 4.0         # Enough for the Arduino to reset and boot after opening the port
+	HANDSHAKE_INTERVAL = 0.5
+	RECONNECT_DELAY = 0.5           # First wait between attempts to reconnect, doubled after every one
+	RECONNECT_MAX_DELAY = 30.0
+	LATE_REPLY_TIME = 2.0           # How long a read that expired may still take its reply, before it's forgotten
+
+	def __init__ (self, use_library=USE_AUTODETECT, ports=None, name='', capture=None):
+		if use_library not in LIBRARY_SCHEMES:
+			raise ValueError("Android is only supported by robotremote")
+		self.name = name
+		self.device = None
+		self._scheme = LIBRARY_SCHEMES[use_library]
 		self._conn = None
-		self._read_lock = False
+		self._reader = None
+		self._parser = FrameParser(self._telemetry_frame)
+		self._frames = Queue()      # Replies received, but the ones to requests
+		self._requests = deque()    # Reads sent and waiting for their replies, in order
+		self._outputs = None        # Channels in the last positions received
+		self._answered = Event()    # Set while no read keeps the firmware busy
+		self._answered.set()
+		self._raw = None            # Queue for the bytes received while uploading, if any
+		self._features = None
+		self._telemetry = None      # Mask and period of the telemetry asked for, sent again after reconnecting
+		self.on_telemetry = None    # Called with (time in ms, values) for every telemetry frame
+		self._link = LinkModel(baud_rate = self.BAUD_RATE)
+		self.upload_stats = None
+		self.metrics = Metrics()
+		self.state = DISCONNECTED
+		self._connected = Event()
+		self._subscribers = []
+		self._supervisor = None     # Greenlet reconnecting in the background, if the connection was lost
+		# Every byte sent and received is recorded in the capture file given, if any
+		self._capture = CaptureWriter(capture) if capture else None
+		# A single device or URL, or a list of them, can be given instead of the default ones (i.e. 'loop://')
+		if isinstance(ports, (str, Transport)):
+			ports = [ports]
+		self.ports = ports or self.DEFAULT_PORTS
 		self.connect()
 
 	def connect (self):
 		if self.is_connected():
 			return
+		self._features = None
+		self._outputs = None
 
-		for device in self.DEFAULT_PORTS:
-			try:
-				self._conn = serial.Serial()
-				self._conn.port = device
-				self._conn.timeout = 10
-				self._conn.baudrate = self.BAUD_RATE
-				self._conn.open()
-				self._conn.flush()
-				sleep(3)	# Allow the connection to stablish
+		# Try first where the robot was found last time, then every other port at the same time
+		for devices in ports_to_probe(self.name, self.ports, self.LAST_PORTS):
+			found = self._probe_all(devices)
+			if found:
 				break
-			except:
-				self._conn = None
-				continue
 
-		if self._conn:
-			print("Connected by ",device)
+		if found:
+			self.device, self._conn, parser = found
+			if self._capture:
+				self._conn.attach(self._capture)
+			print("Connected by ", self.device)
+			if isinstance(self.device, str):
+				save_last_port(self.name, self.device, self.LAST_PORTS)
+			# Replies to the reads that found the robot may come yet, so the parser goes on from where the probe was
+			parser.on_telemetry = self._telemetry_frame
+			self._parser = parser
+			self._reader = spawn(self._read_loop)
+			try:
+				# Whole frames before the reply to the features are dropped
+				self.get_features()
+			except IOError:
+				pass
+			while not self._frames.empty():
+				self._frames.get_nowait()
+				self.metrics.incr('stale_frames')
+			self._set_state(CONNECTED)
+			if self._telemetry:
+				# The firmware resets when the port is opened
+				try:
+					self.send(MISC_COMMAND, [MISC_TELEMETRY] + list(self._telemetry))
+				except IOError:
+					pass
+
+	def subscribe (self):
+		"""
+			Returns a queue that gets (state, error) every time the connection is lost, is being recovered or is
+			back (DISCONNECTED, RECONNECTING, CONNECTED)
+		"""
+		queue = Queue()
+		self._subscribers.append(queue)
+		return queue
+
+	def unsubscribe (self, queue):
+		if queue in self._subscribers:
+			self._subscribers.remove(queue)
+
+	def wait_connected (self, timeout = None):
+		"""
+			Waits until the robot is connected, and returns whether it is
+		"""
+		return self._connected.wait(timeout)
+
+	def _set_state (self, state, error = None):
+		self.state = state
+		if state == CONNECTED:
+			self._connected.set()
+		else:
+			self._connected.clear()
+		for queue in self._subscribers:
+			queue.put((state, error))
+
+	def _connection_lost (self, error):
+		"""
+			Closes the port after an error, and tries to connect again from the background, so whoever was using it
+			doesn't wait meanwhile
+		"""
+		conn, self._conn = self._conn, None
+		if conn is None:
+			return
+		print("Connection lost:", error)
+		if self._reader is not getcurrent():
+			self._reader.kill(block = False)
+		try:
+			conn.close()
+		except (ValueError, IOError):
+			pass
+		self.metrics.incr('disconnects')
+		self._parser.reset()
+		while self._requests:
+			reply = self._requests.popleft()
+			self._release(reply)
+			reply.cancel()
+		self._set_state(DISCONNECTED, error)
+		if self._supervisor is None:
+			self._supervisor = spawn(self._reconnect_loop)
+
+	def _reconnect_loop (self):
+		delay = self.RECONNECT_DELAY
+		try:
+			while not self.is_connected():
+				self._set_state(RECONNECTING)
+				self.connect()
+				if not self.is_connected():
+					self._set_state(DISCONNECTED)
+					sleep(delay)
+					delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+			self.metrics.incr('reconnects')
+		finally:
+			self._supervisor = None
+
+	def _probe_all (self, devices):
+		"""
+			Probes the devices concurrently, and returns (device, port, parser) for the first where a robot answers
+		"""
+		probes = [spawn(self._probe, device) for device in devices]
+		try:
+			for probe in iwait(probes):
+				if probe.value:
+					return probe.value
+		finally:
+			killall(probes)
+		return None
+
+	def _probe (self, device):
+		"""
+			Opens a device or URL and asks for the position of the channels until a robot answers, or HANDSHAKE_TIMEOUT
+			expires. Returns (device, port, parser) if it answered, where the parser is in sync with the bytes received
+		"""
+		try:
+			conn = open_transport(device, self.BAUD_RATE, self._scheme)
+		except (ValueError, IOError):
+			return None
+		if self._capture:
+			conn = CaptureTransport(conn)
+		handshake = Handshake()
+		deadline = monotonic() + self.HANDSHAKE_TIMEOUT
+		try:
+			while monotonic() < deadline:
+				conn.write(Handshake.REQUEST)
+				with Timeout(self.HANDSHAKE_INTERVAL, False):
+					while True:
+						wait_read(conn.fileno())
+						if handshake.feed(conn.read(conn.in_waiting or 1)):
+							found, conn = conn, None
+							return device, found, handshake.parser
+		except (ValueError, IOError):
+			pass
+		finally:
+			if conn:
+				conn.close()
+		return None
 
 	def is_connected (self):
-		return self._conn and self._conn.isOpen()
+		return self._conn is not None and self._conn.is_open
+
+	def _get_conn (self):
+		if not self.is_connected():
+			if self._conn is not None:
+				self._connection_lost(IOError("Port closed"))
+			raise IOError("Not connected to the robot")
+		return self._conn
 
-	def recv (self, length = None, timeout = 2.0):
-		result = []
+	def recv (self, timeout = 2.0):
+		"""
+			Waits for the next reply from the robot, and returns its content without the length
+		"""
 		try:
-			#print("Receiving...")
-			with Timeout(timeout):
-				self.read_lock = True
-				# Get response if any
-				if length is None:
-					while not self._conn.inWaiting(): sleep(0.01)
-					num = self._conn.inWaiting()-1
-					length = struct.unpack('B', self._conn.read(1))[0]
-				i = 0
-				while num > 0 or i < length:
-					while not self._conn.inWaiting(): sleep(0.01)
-					num = self._conn.inWaiting()
-					result.extend((i for i in self._conn.read(num)))
-					i+=num
-					num=0
-		except Timeout as e:
+			return self._frames.get(timeout = timeout)
+		except Empty:
 			print("Receiving timeout...")
-			self._conn.flush()
-			sleep(1)
-			result = None
-		finally:
-			self._read_lock = False
-		return result
+			self.metrics.incr('recv_timeouts')
+			return None
 
-	def send (self, cmd, params, max_retries = 3, flush = False):
-		retries = 1
-		data = struct.pack('B', cmd)
+	def request (self, subcmd, reply = None):
+		"""
+			Asks for the positions (MISC_GET_POSITIONS), sensors (MISC_GET_SENSORS) or features (MISC_GET_FEATURES),
+			and returns a Reply set to their values as soon as they are received, without waiting
+		"""
+		reply = reply or Reply()
+		if reply.length is None:
+			reply.length = self._outputs if subcmd == MISC_GET_POSITIONS else REPLY_LENGTHS.get(subcmd)
+		reply.sent = (subcmd, monotonic())
+		self._requests.append(reply)
 		try:
-			data += struct.pack('B', params)
-		except struct.error:
-			for i in params:
-				data += struct.pack('B', i)
-		while True:
+			self.send(MISC_COMMAND, subcmd)
+		except IOError:
+			self._requests.remove(reply)
+			raise
+		reply.sent = (subcmd, monotonic())
+		# The firmware reads nothing else until it has answered (i.e. about 90 ms for the sensors)
+		self._link.hold(monotonic())
+		reply.holding = True
+		self._answered.clear()
+		spawn_later(reply.timeout, self._expire, reply)
+		return reply
+
+	def reads_pending (self):
+		"""
+			Returns whether a read is waiting for its reply, so the firmware may be busy answering it
+		"""
+		return any(reply.holding for reply in self._requests)
+
+	def wait_reads (self, timeout = None):
+		"""
+			Waits until the reads sent have their reply, or have expired. Returns whether they have
+		"""
+		return self._answered.wait(timeout)
+
+	def _release (self, reply):
+		if reply.holding:
+			reply.holding = False
+			self._link.release(monotonic())
+			if not self.reads_pending():
+				self._answered.set()
+
+	def _expire (self, reply):
+		"""
+			Gives up waiting for a reply. It stays in the queue of reads for LATE_REPLY_TIME, to take its frame if it
+			comes late, but the one for the features, as old firmware doesn't answer it
+		"""
+		if reply not in self._requests:
+			return
+		# The firmware is done with it by now, even if it was cancelled before
+		self._release(reply)
+		if not reply.ready():
+			print("Receiving timeout...")
+			self.metrics.incr('recv_timeouts')
+			reply.cancel()
+		if reply.sent[0] == MISC_GET_FEATURES:
+			self._requests.remove(reply)
+		else:
+			spawn_later(self.LATE_REPLY_TIME, self._forget, reply)
+
+	def _forget (self, reply):
+		if reply in self._requests:
+			self._requests.remove(reply)
+			self.metrics.incr('lost_replies')
+
+	@staticmethod
+	def _fits (reply, frame):
+		if reply.length is None:
+			return len(frame) <= MAX_OUTPUTS
+		return len(frame) == reply.length
+
+	def _reply (self, frame):
+		"""
+			Gives a reply to the oldest read waiting whose values it has, or to recv() if none is waiting. The reads
+			before it never got their reply (i.e. it was lost), and are dropped
+		"""
+		if not self._requests:
+			self._frames.put(frame)
+			return
+		# Reads whose reply is late are more likely lost than about to get it, when the frame can only be the reply
+		# to the read waiting yet
+		fits = [i for i, reply in enumerate(self._requests) if self._fits(reply, frame)]
+		waiting = [i for i in fits if not self._requests[i].ready() and self._requests[i].length is not None]
+		index = (waiting or fits or [None])[0]
+		head = self._requests[0]
+		if index is None and head.sent[0] == MISC_GET_POSITIONS and not head.ready():
+			# The channels in use changed (i.e. a configuration loaded from the EEPROM)
+			index = 0
+		if index is None:
+			# Replies to the reads that found the robot may come yet, before the features
+			self.metrics.incr('stale_frames')
+			return
+		for _ in range(index):
+			lost = self._requests.popleft()
+			self._release(lost)
+			lost.cancel()
+			self.metrics.incr('lost_replies')
+		reply = self._requests.popleft()
+		self._release(reply)
+		if reply.ready():
+			# The read expired or was cancelled, but its reply came anyway
+			self.metrics.incr('late_replies')
+			return
+		reply.received = monotonic()
+		subcmd, sent = reply.sent
+		if subcmd == MISC_GET_POSITIONS:
+			self._outputs = len(frame)
+		self.metrics.observe(READ_METRICS[subcmd], reply.received - sent)
+		reply.set(frame)
+
+	def _read_loop (self):
+		"""
+			Waits until there are bytes to read, and passes them to the frame parser, or to the upload in progress
+		"""
+		conn = self._conn
+		while conn is self._conn:
 			try:
-				#print("Writing", len(data), "bytes\n", cmd, "\n",  params)
-				# Serial read buffer in arduino is normally 64 bytes
-				for start in range(0, len(data), 32):
-					chunk = data[start:start + 32]
-					#print("sending chunk:", chunk)
-					self._conn.write(chunk)
-					sleep(0.1)
-				if flush:
-					self._conn.flush()
-				sleep(0.01)
+				wait_read(conn.fileno())
+				data = conn.read(conn.in_waiting or 1)
+			except (ValueError, IOError) as e:
+				if conn is self._conn:
+					self._connection_lost(e)
 				break
-			except (serial.SerialException, ValueError, IOError) as e:
-				print("Error?", e)
-				sleep(1)
-				print("Reconnecting...", retries)
+			self.metrics.incr('bytes_read', len(data))
+			if self._raw is not None:
+				# Telemetry frames sent before the upload started may come yet
+				data = self._parser.strip(data)
+				if data:
+					self._raw.put(data)
+			else:
+				for frame in self._parser.feed(data):
+					self._reply(frame)
+
+	def send (self, cmd, params, flush = False):
+		"""
+			Writes a command without overflowing the receive buffer in the Arduino. Raises IOError at once if the
+			robot is not connected, or if the connection is lost, while it reconnects in the background
+		"""
+		return self.write(encode(cmd, params), flush)
+
+	def write (self, data, flush = False):
+		"""
+			Same as send, for several commands already encoded, written at once
+		"""
+		conn = self._get_conn()
+		try:
+			# Serial read buffer in arduino is normally 64 bytes
+			for start in range(0, len(data), self.CHUNK_SIZE):
+				chunk = data[start:start + self.CHUNK_SIZE]
+				# Checked again after waiting, as the firmware may be answering a read meanwhile
+				while self._link.wait_time(len(chunk), monotonic()):
+					self._wait(self._link.wait_time(len(chunk), monotonic()))
+				self._write(conn, chunk)
+				self._link.add(len(chunk), monotonic())
+			if flush:
+				conn.flush()
+		except (ValueError, IOError) as e:
+			self._connection_lost(e)
+			raise IOError("Unable to send %d bytes to robot: %s" % (len(data), e))
+		return True
+
+	def backlog (self):
+		"""
+			Seconds the firmware needs to read the bytes already written
+		"""
+		return self._link.drain_time(monotonic())
+
+	def get_features (self):
+		"""
+			Asks the firmware which features it supports, once per connection. Old firmware doesn't answer
+		"""
+		if self._features is None:
+			reply = self.request(MISC_GET_FEATURES, Reply(timeout = 0.5)).get()
+			self._features = reply[0] if reply else 0
+		return self._features
+
+	def set_telemetry (self, mask, period):
+		"""
+			Makes the firmware push the analog inputs in the mask (bit 0 for A0) every period (1-255 ms), given to
+			on_telemetry as they come, or stops it with mask 0. Returns False if the firmware doesn't support it
+		"""
+		if mask and not self.get_features() & FEATURE_TELEMETRY:
+			return False
+		self._telemetry = (mask, period) if mask else None
+		self.send(MISC_COMMAND, [MISC_TELEMETRY, mask, period])
+		return True
+
+	def _telemetry_frame (self, millis, values):
+		self.metrics.incr('telemetry.frames')
+		if self.on_telemetry:
+			self.on_telemetry(millis, values)
+
+	def upload (self, data, timeout = 2.0):
+		"""
+			Sends configuration and programs to the robot, as given by RobotProgram.get_all_raw_code, starting
+			by the subcommand to store them in RAM (255) or EEPROM (253), without overflowing the 64-byte receive
+			buffer in the Arduino. When the firmware grants credits, it writes as much as they allow, otherwise
+			it follows a model of the line and of the time the firmware takes to store every byte.
+			Returns the throughput achieved in bytes per second, or None if the robot stopped answering
+		"""
+		self._outputs = None
+		upload = Upload(data, self.get_features(), self.BAUD_RATE)
+		start = monotonic()
+		try:
+			if upload.mode == 'credits':
+				done = self._upload_with_credits(upload, timeout)
+			else:
+				done = self._upload_with_timing(upload)
+		except (ValueError, IOError) as e:
+			self._connection_lost(e)
+			raise IOError("Unable to upload %d bytes to robot: %s" % (len(upload.data), e))
+		elapsed = monotonic() - start
+		if not done:
+			print("Upload timeout...")
+			self.metrics.incr('upload_timeouts')
+			return None
+		self.metrics.observe('rtt.upload', elapsed)
+		self.upload_stats = upload.stats(elapsed)
+		return self.upload_stats['rate']
+
+	def _upload_with_credits (self, upload, timeout):
+		self._raw = Queue()
+		try:
+			while True:
+				chunk = upload.allowed()
+				if chunk:
+					self._write(self._get_conn(), chunk)
 				try:
-					if self._conn:
-						self._conn.close()
-				except:
-					pass
-				self._conn = None
-				self._connect()
-			if retries > max_retries:
-				raise IOError("Unable to send %d bytes to robot" % len(data))
-			retries += 1
+					done = upload.received(self._raw.get(timeout = timeout))
+				except Empty:
+					return False
+				if done is not None:
+					return done
+		finally:
+			self._raw = None
 
+	def _upload_with_timing (self, upload):
+		for chunk in upload.chunks(self.CHUNK_SIZE):
+			self._wait(upload.link.wait_time(len(chunk), monotonic()))
+			self._write(self._get_conn(), chunk)
+			upload.link.add(len(chunk), monotonic())
+		# Wait until the firmware should have stored everything
+		sleep(upload.link.drain_time(monotonic()))
 		return True
-	
+
+	def _wait (self, seconds):
+		"""
+			Waits for the firmware to make room for the next chunk
+		"""
+		if seconds > 0:
+			self.metrics.observe('pacing', seconds)
+			sleep(seconds)
+
+	def _write (self, conn, chunk):
+		start = monotonic()
+		conn.write(chunk)
+		self.metrics.observe('write', monotonic() - start)
+		self.metrics.incr('bytes_written', len(chunk))
+
+	def close (self):
+		"""
+			Closes the port, without reconnecting, and the capture if any
+		"""
+		if self._supervisor:
+			self._supervisor.kill(block = False)
+		conn, self._conn = self._conn, None
+		if conn is not None:
+			if self._reader is not getcurrent():
+				self._reader.kill(block = False)
+			conn.close()
+			self._set_state(DISCONNECTED)
+		if self._capture:
+			self._capture.close()
+			self._capture = None
+
 	def __del__ (self):
 		try:
 			if self._conn:
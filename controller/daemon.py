@@ -0,0 +1,200 @@
+# This module shares one robot among several local programs, serving its protocol over a Unix socket
+
+import os
+import sys
+from collections import deque
+from gevent import spawn, socket
+from gevent.event import Event, AsyncResult
+from gevent.server import StreamServer
+from connection import RobotConnection
+from protocol import (MISC_COMMAND, MISC_GET_POSITIONS, MISC_GET_SENSORS, MISC_GET_FEATURES, MISC_UPLOAD_EEPROM,
+	MISC_UPLOAD_RAM, MISC_UPLOAD_EEPROM_CREDITS, MISC_UPLOAD_RAM_CREDITS, MISC_UPLOADS, MISC_TELEMETRY,
+	FEATURE_UPLOAD_CREDITS, FEATURE_TELEMETRY, TELEMETRY_FRAME, UPLOAD_CREDIT, UPLOAD_DONE, UPLOAD_CREDIT_SIZE, MAX_OUTPUTS, CommandParser)
+
+"""
+   Usage: python3 daemon.py [port] [socket]
+   Then, every program can use Robot(prefix, port='unix:///tmp/leggedbot.sock') at the same time
+"""
+
+class RobotDaemon(object):
+	"""
+		Owns the connection with a robot, and serves the same protocol to every client of a Unix socket, so each
+		of them talks to the robot as if it were alone:
+		- Only the last command given to every channel is sent, whichever client gave it
+		- Control commands, loads and uploads are sent in the order they come, one at a time
+		- Reads of positions or sensors share the reply of the same read still pending, and it's sent to all
+		  the clients that asked for it
+		- Telemetry frames are sent to every client, as asked for by the last one that started or stopped it
+	"""
+
+	SOCKET = '/tmp/leggedbot.sock'
+	UPLOAD_KEEPALIVE = 0.5          # Credits sent to a client while its upload waits for the robot
+
+	def __init__ (self, port = None, path = SOCKET, name = ''):
+		self.path = path
+		self._conn = RobotConnection(ports = port, name = name)
+		if not self._conn.is_connected():
+			raise IOError("Robot not found")
+		# Asked once, before clients can send reads
+		self._features = FEATURE_UPLOAD_CREDITS | (self._conn.get_features() & FEATURE_TELEMETRY)
+		self._conn.on_telemetry = self._telemetry_frame
+		self._server = None
+		self._clients = set()
+		# Last command for every channel, and queue for the rest of commands, as (client, command, result)
+		self._channel_commands = [None for i in range(MAX_OUTPUTS)]
+		self._control_commands = deque()
+		# Clients waiting for every read
+		self._readers = {MISC_GET_POSITIONS: [], MISC_GET_SENSORS: []}
+		self._wakeup = Event()
+		self._process_commands = None
+
+	def serve_forever (self):
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+		listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		listener.bind(self.path)
+		listener.listen(16)
+		self._server = StreamServer(listener, self._handle)
+		self._process_commands = spawn(self._process_commands_loop)
+		try:
+			self._server.serve_forever()
+		finally:
+			self.stop()
+
+	def stop (self):
+		if self._server:
+			self._server.stop()
+			self._server = None
+			os.unlink(self.path)
+		if self._process_commands:
+			self._process_commands.kill()
+			self._process_commands = None
+
+	def _handle (self, client, address):
+		"""
+			Reads the commands of a client until it disconnects. Uploads with credits are granted them as they are
+			read, and finished when the robot has stored them
+		"""
+		self._clients.add(client)
+		parser = CommandParser()
+		uploaded = 0
+		try:
+			while True:
+				data = client.recv(4096)
+				if not data:
+					break
+				commands = parser.feed(data)
+				if any(self._is_credit_upload(c) for c in commands + [parser.pending()]):
+					uploaded += len(data)
+					self._reply(client, bytes([UPLOAD_CREDIT]) * (uploaded // UPLOAD_CREDIT_SIZE))
+					uploaded %= UPLOAD_CREDIT_SIZE
+				for command in commands:
+					self._dispatch(client, command)
+		except OSError:
+			pass
+		finally:
+			self._clients.discard(client)
+			for readers in self._readers.values():
+				while client in readers:
+					readers.remove(client)
+			client.close()
+
+	@staticmethod
+	def _is_credit_upload (command):
+		return len(command) > 1 and command[0] == MISC_COMMAND and command[1] in (MISC_UPLOAD_EEPROM_CREDITS, MISC_UPLOAD_RAM_CREDITS)
+
+	def _dispatch (self, client, command):
+		cmd, subcmd = command[0], command[1]
+		if cmd < 253:
+			self._channel_commands[cmd & 15] = (client, command, None)
+		elif cmd == MISC_COMMAND and subcmd == MISC_GET_FEATURES:
+			# Uploads from clients are always paced by credits, whatever the robot supports
+			self._reply(client, bytes([1, self._features]))
+			return
+		elif cmd == MISC_COMMAND and subcmd in self._readers:
+			self._readers[subcmd].append(client)
+			if len(self._readers[subcmd]) > 1:
+				return
+			self._control_commands.append((client, command, None))
+		elif cmd == MISC_COMMAND and subcmd in MISC_UPLOADS:
+			result = AsyncResult()
+			if self._is_credit_upload(command):
+				spawn(self._keep_upload_alive, client, result)
+			self._control_commands.append((client, command, result))
+		else:
+			self._control_commands.append((client, command, None))
+		self._wakeup.set()
+
+	def _keep_upload_alive (self, client, result):
+		"""
+			Keeps a client waiting for its upload while it's queued or being sent to the robot, as the firmware
+			does, and tells it when it's done
+		"""
+		while True:
+			result.wait(self.UPLOAD_KEEPALIVE)
+			if result.ready():
+				break
+			self._reply(client, bytes([UPLOAD_CREDIT]))
+		if result.get():
+			self._reply(client, bytes([UPLOAD_DONE]))
+
+	def _telemetry_frame (self, millis, values):
+		frame = bytes([TELEMETRY_FRAME | len(values), millis & 0xff, millis >> 8] + list(values))
+		for client in list(self._clients):
+			self._reply(client, frame)
+
+	def _reply (self, client, data):
+		if data and client in self._clients:
+			try:
+				client.sendall(data)
+			except OSError:
+				pass
+
+	def _process_commands_loop (self):
+		"""
+			Sends every last command given to a channel, and the rest of commands in order
+		"""
+		while True:
+			self._wakeup.wait()
+			self._wakeup.clear()
+			while self._control_commands or any(self._channel_commands):
+				for i, command in enumerate(self._channel_commands):
+					if command:
+						self._channel_commands[i] = None
+						self._send(*command)
+				if self._control_commands:
+					self._send(*self._control_commands.popleft())
+
+	def _send (self, client, command, result):
+		cmd, subcmd = command[0], command[1]
+		try:
+			if cmd == MISC_COMMAND and subcmd in self._readers:
+				# Clients asking from now on need a new read
+				readers, self._readers[subcmd] = self._readers[subcmd], []
+				reply = self._conn.request(subcmd).get()
+				if reply is not None:
+					for reader in readers:
+						self._reply(reader, bytes([len(reply)] + reply))
+			elif cmd == MISC_COMMAND and subcmd in MISC_UPLOADS:
+				# The connection with the robot chooses how to pace it
+				to_eeprom = subcmd in (MISC_UPLOAD_EEPROM, MISC_UPLOAD_EEPROM_CREDITS)
+				data = bytes([MISC_UPLOAD_EEPROM if to_eeprom else MISC_UPLOAD_RAM]) + command[2:]
+				result.set(self._conn.upload(data) is not None)
+			elif cmd == MISC_COMMAND and subcmd == MISC_TELEMETRY:
+				self._conn.set_telemetry(command[2], command[3])
+			else:
+				self._conn.send(cmd, subcmd)
+		except IOError as e:
+			print("Error sending to robot", e)
+		finally:
+			if result is not None and not result.ready():
+				result.set(False)
+
+
+if __name__ == '__main__':
+	daemon = RobotDaemon(
+		port = sys.argv[1] if len(sys.argv) > 1 else None,
+		path = sys.argv[2] if len(sys.argv) > 2 else RobotDaemon.SOCKET,
+	)
+	print("Serving robot on", daemon.path)
+	daemon.serve_forever()
@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+# This module emulates the robot firmware (leggedbot.ino), so the host side can be used without an Arduino
+
+import os
+import sys
+import tty
+import select
+import random
+import threading
+from collections import deque
+from time import monotonic
+from protocol import (BAUD_RATE, BYTE_TIME, RX_BUFFER, EEPROM_WRITE_TIME, FEATURE_UPLOAD_CREDITS, FEATURE_TELEMETRY,
+	UPLOAD_CREDIT, UPLOAD_DONE, UPLOAD_CREDIT_SIZE, TELEMETRY_FRAME, TELEMETRY_INPUTS as ANALOG_INPUTS, PERIOD,
+	MIN_PULSE_WIDTH, MAX_PULSE_WIDTH, arduino_map, trunc_div)
+
+MEM_FOR_PROGRAMS = 1024
+EEPROM_LENGTH = 1024
+MAX_CHANNELS = 12
+FIRMWARE_FEATURES = FEATURE_UPLOAD_CREDITS | FEATURE_TELEMETRY
+ANALOG_READ_TIME = 0.000112 # Time taken by analogRead()
+
+
+class VirtualClock(object):
+	"""
+		Clock for the emulated robot. With speed 1.0 it follows the wall clock, bigger values run faster
+		than real time, and speed 0 stops it, so time only moves when advance() is called
+	"""
+
+	def __init__ (self, speed = 1.0):
+		self.speed = speed
+		self._base = 0.0
+		self._wall = monotonic()
+
+	def time (self):
+		return self._base + (monotonic() - self._wall) * self.speed
+
+	def advance (self, seconds):
+		self._base += seconds
+
+	def to_wall (self, seconds):
+		"""
+			Returns the wall clock time needed for the emulated time given to pass, or None if it never will
+		"""
+		if not self.speed:
+			return None
+		return max(0.0, seconds / self.speed)
+
+
+class RobotEmulator(object):
+	"""
+		Emulates the firmware running in the robot, byte by byte, as seen from its serial line.
+		- Host bytes travel at BAUD_RATE and are dropped when the 64-byte receive buffer is full.
+		- The main loop, command processing, program execution and configuration uploads follow leggedbot.ino,
+		including the time spent in delays, analog reads and EEPROM writes.
+		- The ISR is called every PERIOD to move current positions towards desired positions.
+		- Nunchuck input and pulse generation are not emulated.
+		It can be driven by hand with write(), run_until() and read(), or served over a pty or socket with serve()
+	"""
+
+	BAUD_RATE = BAUD_RATE
+	BYTE_TIME = BYTE_TIME
+
+	def __init__ (self, clock = None, eeprom = None, seed = None):
+		self.clock = clock or VirtualClock()
+		self.eeprom = bytearray(eeprom) if eeprom else self.default_eeprom()
+		self.analog = [0 for i in range(ANALOG_INPUTS)]    # Values for analog inputs A0-A5 (0-1023)
+		self.programs = bytearray(MEM_FOR_PROGRAMS)
+		self.programs[0] = 255
+		self.total_programs = 0
+		self.program_offset = 0
+		self.ticks_per_step = 6
+		self.total_outputs = MAX_CHANNELS
+		self.uploading = False
+		self.upload_credits = False
+		self.upload_read = 0
+		self.step_tick = 0
+		self.activity = [0 for i in range(MAX_CHANNELS)]
+		self.delta = [0 for i in range(MAX_CHANNELS)]
+		self.desired_pos = [0 for i in range(MAX_CHANNELS)]
+		self.min_range = [0 for i in range(MAX_CHANNELS)]
+		self.max_range = [255] + [0 for i in range(MAX_CHANNELS - 1)]
+		self.inverted_channels = 0
+		self.current_pos = [0 for i in range(MAX_CHANNELS)]
+		self.telemetry_mask = 0
+		self.telemetry_period = 0
+		self.telemetry_next = 0         # Milliseconds
+		self.overruns = 0               # Bytes lost because the receive buffer was full
+		self.now = 0.0                  # Emulated time already processed
+		self._next_tick = PERIOD
+		self._busy_until = 0.0
+		self._line = deque()            # Bytes travelling from the host, as (arrival time, byte)
+		self._line_free = 0.0
+		self._rx = deque()              # Bytes in the receive buffer of the Arduino
+		self._tx = deque()              # Bytes travelling to the host, as (arrival time, byte)
+		self._tx_free = 0.0
+		self._random = random.Random(seed)
+		self._lock = threading.RLock()
+		self._serving = False
+		self._slave = None
+		self._firmware = self._main()
+
+	@staticmethod
+	def default_eeprom ():
+		"""
+			EEPROM as left by an upload with no programs, 12 channels in full range and 6 ticks per step
+		"""
+		eeprom = bytearray(EEPROM_LENGTH)
+		eeprom[3] = ((6 - 1) << 4) + (MAX_CHANNELS - 1)
+		for i in range(MAX_CHANNELS):
+			eeprom[(i << 1) + 5] = 255
+		return eeprom
+
+	def analog_read (self, pin):
+		return self.analog[pin]
+
+	def write (self, data):
+		"""
+			Sends bytes from the host to the robot. They arrive one after another at the speed of the line
+		"""
+		with self._lock:
+			for byte in bytearray(data):
+				self._line_free = max(self._line_free, self.now) + self.BYTE_TIME
+				self._line.append((self._line_free, byte))
+
+	def read (self):
+		"""
+			Returns the bytes that have already reached the host
+		"""
+		with self._lock:
+			data = bytearray()
+			while self._tx and self._tx[0][0] <= self.now:
+				data.append(self._tx.popleft()[1])
+			return bytes(data)
+
+	def advance (self, seconds):
+		"""
+			Runs the emulation for a number of seconds of emulated time, and returns what the robot wrote
+		"""
+		self.run_until(self.now + seconds)
+		return self.read()
+
+	def run_until (self, t):
+		"""
+			Runs the firmware until the emulated time given
+		"""
+		with self._lock:
+			while True:
+				self._receive()
+				if self._busy_until > self.now:
+					target = self._busy_until
+				else:
+					delay = next(self._firmware)
+					if delay:
+						self._busy_until = self.now + delay
+						continue
+					target = self._next_tick
+					if self._line:
+						target = min(target, self._line[0][0])
+					if self.telemetry_mask and self.telemetry_next / 1000.0 > self.now:
+						target = min(target, self.telemetry_next / 1000.0)
+				if target > t:
+					self._advance_to(t)
+					break
+				self._advance_to(target)
+
+	def next_event (self):
+		"""
+			Emulated time when something will be seen by the host or by the firmware, if anything is pending
+		"""
+		with self._lock:
+			times = []
+			if self._tx:
+				times.append(self._tx[0][0])
+			if self._line:
+				times.append(self._line[0][0])
+			if self._busy_until > self.now:
+				times.append(self._busy_until)
+			if self.telemetry_mask:
+				times.append(self.telemetry_next / 1000.0)
+			return min(times) if times else None
+
+	def open_pty (self):
+		"""
+			Creates a pseudo-terminal served by the emulator, and returns its path so it can be opened as a serial port
+		"""
+		master, slave = os.openpty()
+		tty.setraw(slave)
+		self._slave = slave     # Keep it open so the master does not hang up when the host closes the port
+		threading.Thread(target = self.serve, args = (master, ), daemon = True).start()
+		return os.ttyname(slave)
+
+	def serve (self, fd):
+		"""
+			Serves the serial line of the robot over a file descriptor (pty master or socket) until stop() is called
+			or the other side closes it
+		"""
+		self._serving = True
+		try:
+			while self._serving:
+				self.run_until(self.clock.time())
+				data = self.read()
+				if data:
+					os.write(fd, data)
+				timeout = 0.1
+				event = self.next_event()
+				if event is not None:
+					wait = self.clock.to_wall(event - self.clock.time())
+					if wait is not None:
+						timeout = min(timeout, wait)
+				readable, _, _ = select.select([fd], [], [], timeout)
+				if readable:
+					try:
+						data = os.read(fd, 4096)
+					except OSError:
+						break
+					if not data:
+						break
+					self.run_until(self.clock.time())
+					self.write(data)
+		finally:
+			self._serving = False
+			os.close(fd)
+
+	def stop (self):
+		self._serving = False
+
+	def _advance_to (self, t):
+		while self._next_tick <= t:
+			self.now = self._next_tick
+			self._receive()
+			self._isr()
+			self._next_tick += PERIOD
+		self.now = max(self.now, t)
+		self._receive()
+
+	def _receive (self):
+		while self._line and self._line[0][0] <= self.now:
+			byte = self._line.popleft()[1]
+			if len(self._rx) < RX_BUFFER:
+				self._rx.append(byte)
+			else:
+				self.overruns += 1
+
+	# The firmware is written as a generator. It yields a delay in seconds when it is busy, or None when it
+	# is waiting for a new byte or the next tick of the ISR
+
+	def _serial_read (self):
+		while not self._rx:
+			yield None
+		return self._rx.popleft()
+
+	def _serial_write (self, value):
+		self._tx_free = max(self._tx_free, self.now) + self.BYTE_TIME
+		self._tx.append((self._tx_free, value & 0xff))
+
+	def _upload_read (self):
+		value = yield from self._serial_read()
+		if self.upload_credits:
+			self.upload_read += 1
+			if self.upload_read % UPLOAD_CREDIT_SIZE == 0:
+				self._serial_write(UPLOAD_CREDIT)
+		return value
+
+	def _upload_done (self):
+		if self.upload_credits:
+			self._serial_write(UPLOAD_DONE)
+			self.upload_credits = False
+
+	def _millis (self):
+		return int(self.now * 1000 + 1e-9)
+
+	def _send_telemetry (self):
+		inputs = [i for i in range(ANALOG_INPUTS) if self.telemetry_mask & (1 << i)]
+		now = self._millis()
+		self._serial_write(TELEMETRY_FRAME | len(inputs))
+		self._serial_write(now)
+		self._serial_write(now >> 8)
+		for i in inputs:
+			# A read to let the ADC settle, and the one sent
+			yield 2 * ANALOG_READ_TIME
+			self._serial_write(arduino_map(self.analog_read(i), 0, 1023, 0, 255))
+
+	def _serial_flush (self):
+		if self._tx_free > self.now:
+			yield self._tx_free - self.now
+
+	def _eeprom_read (self, address):
+		return self.eeprom[address] if address < len(self.eeprom) else 0
+
+	def _eeprom_update (self, address, value):
+		if address < len(self.eeprom) and self.eeprom[address] != value:
+			self.eeprom[address] = value
+			yield EEPROM_WRITE_TIME
+
+	def _main (self):
+		# setup()
+		yield from self._load_configuration(0)
+		for i in range(MAX_CHANNELS):
+			self.desired_pos[i] = (self.min_range[i] + self.max_range[i]) >> 1
+			self.current_pos[i] = self.desired_pos[i]
+		# loop()
+		while True:
+			if self.telemetry_mask and self._millis() >= self.telemetry_next:
+				period = self.telemetry_period
+				self.telemetry_next += period * ((self._millis() - self.telemetry_next) // period + 1)
+				yield from self._send_telemetry()
+			if len(self._rx) >= 2:
+				cmd = self._rx.popleft()
+				pos = self._rx.popleft()
+				yield from self._process_command(cmd, pos)
+			elif self.total_programs and self.program_offset and not self.step_tick:
+				self.step_tick = self.ticks_per_step
+				yield from self._run_program_step()
+			else:
+				yield None
+
+	def _run_program (self, num):
+		if num <= self.total_programs:
+			self.program_offset = self.programs[(num - 1) << 1] | (self.programs[((num - 1) << 1) + 1] << 8)
+
+	def _run_program_step (self):
+		while self.program_offset:
+			cmd = self.programs[self.program_offset]
+			if cmd == 255:
+				self.program_offset += 1
+				break
+			pos = self.programs[self.program_offset + 1]
+			self.program_offset += 2
+			yield from self._process_command(cmd, pos)
+
+	def _load_configuration (self, from_source = 0):
+		self.uploading = True
+		if from_source:
+			length = yield from self._upload_read()
+			length |= (yield from self._upload_read()) << 8
+		else:
+			length = self.eeprom[0] | (self.eeprom[1] << 8)
+		length = min(length, len(self.eeprom) if from_source == 2 else MEM_FOR_PROGRAMS)
+
+		if from_source:
+			self.total_programs = yield from self._upload_read()
+			ticks_per_step = yield from self._upload_read()
+		else:
+			self.total_programs = self.eeprom[2]
+			ticks_per_step = self.eeprom[3]
+
+		if from_source == 2:
+			yield from self._eeprom_update(0, length & 0xff)
+			yield from self._eeprom_update(1, length >> 8)
+			yield from self._eeprom_update(2, self.total_programs)
+			yield from self._eeprom_update(3, ticks_per_step)
+
+		self.total_outputs = (ticks_per_step & 15) + 1
+		self.ticks_per_step = (ticks_per_step >> 4) + 1
+
+		if from_source == 2:
+			for i in range(2 + length + (self.total_outputs << 1)):
+				value = yield from self._upload_read()
+				yield from self._eeprom_update(4 + i, value)
+			self._upload_done()
+			self.uploading = False
+			return
+
+		for i in range(self.total_outputs):
+			if from_source:
+				min_range = yield from self._upload_read()
+				max_range = yield from self._upload_read()
+			else:
+				min_range = self._eeprom_read((i << 1) + 4)
+				max_range = self._eeprom_read((i << 1) + 5)
+			if i < MAX_CHANNELS:
+				self.min_range[i] = arduino_map(min_range, 0, 255, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH)
+				self.max_range[i] = arduino_map(max_range, 0, 255, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH)
+
+		if from_source:
+			self.inverted_channels = yield from self._upload_read()
+			self.inverted_channels |= (yield from self._upload_read()) << 8
+		else:
+			self.inverted_channels = self._eeprom_read((self.total_outputs << 1) + 4)
+			self.inverted_channels |= self._eeprom_read((self.total_outputs << 1) + 5) << 8
+
+		for i in range(length):
+			if from_source:
+				self.programs[i] = yield from self._upload_read()
+			else:
+				self.programs[i] = self._eeprom_read(i + (self.total_outputs << 1) + 6)
+		self._upload_done()
+		self.uploading = False
+
+	def _move_program_offset (self, lines):
+		inc = 1 if lines >= 0 else -1
+		lc = 0
+		while abs(lc) < abs(lines) and 0 <= self.program_offset < MEM_FOR_PROGRAMS:
+			if self.programs[self.program_offset] == 255:
+				lc += inc
+				self.program_offset += inc
+			else:
+				self.program_offset += 2 * inc
+
+	def _process_command (self, cmd, pos):
+		if self.uploading:
+			return
+
+		if cmd == 253:              # Jump, branching and delay commands
+			subcmd = pos >> 5
+			pos = pos & 31
+			if subcmd == 0:             # sleep
+				yield pos + 1.0
+			elif subcmd == 1:           # jump
+				self._move_program_offset(pos - 16)
+			elif subcmd in (2, 3):      # jleft, jright
+				first, second = (0, 1) if subcmd == 2 else (1, 0)
+				tmp = self.analog_read(first)
+				yield 0.015
+				if tmp > self.analog_read(second):
+					self._move_program_offset(pos - 16)
+			elif subcmd == 4:           # jrand
+				if self._random.randrange(100) >= 50:
+					self._move_program_offset(pos - 16)
+			elif subcmd == 5:           # ticks
+				self.ticks_per_step = pos + 1
+			return
+		elif cmd == 254:            # Program control command
+			if pos == 0:
+				self.program_offset = 0
+			else:
+				self._run_program(pos)
+			return
+		elif cmd == 255:            # Misc commands
+			if pos == 0:
+				self._serial_write(self.total_outputs)
+				for i in range(self.total_outputs):
+					# Serial.write() only sends the lower byte of the pulse width
+					self._serial_write(self.current_pos[i] if i < MAX_CHANNELS else 0)
+			elif pos == 1:
+				self._serial_write(ANALOG_INPUTS)
+				for i in range(ANALOG_INPUTS):
+					self._serial_write(arduino_map(self.analog_read(i), 0, 1023, 0, 255))
+					yield 0.015
+			elif pos == 2:
+				self._serial_write(1)
+				self._serial_write(FIRMWARE_FEATURES)
+			elif pos == 3:
+				self.telemetry_mask = (yield from self._serial_read()) & ((1 << ANALOG_INPUTS) - 1)
+				self.telemetry_period = max((yield from self._serial_read()), 1)
+				self.telemetry_next = self._millis()
+			elif pos in (251, 252):
+				self.upload_credits = True
+				self.upload_read = 0
+				yield from self._load_configuration(2 if pos == 251 else 1)
+			elif pos == 253:
+				yield from self._load_configuration(2)
+			elif pos == 254:
+				yield from self._load_configuration(0)
+			elif pos == 255:
+				yield from self._load_configuration(1)
+			yield from self._serial_flush()
+			return
+
+		speed = 1 + (cmd >> 4)
+		channel = cmd & 15
+		if channel >= MAX_CHANNELS:
+			return
+		self.activity[channel] = self.ticks_per_step << 3
+
+		if self.inverted_channels & (1 << channel):
+			pos = 255 - pos
+
+		self.desired_pos[channel] = arduino_map(pos, 0, 255, self.min_range[channel], self.max_range[channel])
+		self.delta[channel] = trunc_div((self.desired_pos[channel] - self.current_pos[channel]) * speed, 16)
+
+	def _isr (self):
+		if self.step_tick > 0 and not self.uploading and self.total_programs > 0:
+			self.step_tick -= 1
+
+		for i in range(min(self.total_outputs, MAX_CHANNELS)):
+			if not self.activity[i]:
+				continue
+			self.activity[i] -= 1
+			z = self.desired_pos[i]
+			y = self.delta[i]
+			self.current_pos[i] += y
+			if y < 0:
+				if self.current_pos[i] <= z:
+					self.delta[i] = 0
+					self.current_pos[i] = z
+			elif y > 0:
+				if self.current_pos[i] >= z:
+					self.delta[i] = 0
+					self.current_pos[i] = z
+			else:
+				self.current_pos[i] = z
+
+
+if __name__ == '__main__':
+	speed = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+	emulator = RobotEmulator(clock = VirtualClock(speed))
+	print("Emulated robot listening on", emulator.open_pty())
+	try:
+		while True:
+			threading.Event().wait(1)
+	except KeyboardInterrupt:
+		emulator.stop()
@@ -0,0 +1,115 @@
+# This module predicts the position of the servos from the commands sent, as the firmware moves them
+
+from protocol import PERIOD, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH, arduino_map, trunc_div
+
+
+class ServoEstimator(object):
+	"""
+		Follows the position of every active channel (numbered among the active ones, as in the firmware) from
+		the commands sent to them, doing what the ISR does every PERIOD: adding the delta given by the speed of
+		the last command to the current pulse width until it reaches the desired one, for ticks_per_step * 8
+		ticks. ISR ticks are taken at multiples of PERIOD of the host clock, as their phase is unknown.
+		Programs running in the robot move the channels too, so it has to be synced with a read from then on
+	"""
+
+	def __init__ (self, channels_setup, ticks_per_step = 6):
+		self.current = []
+		self.desired = []
+		self.delta = []
+		self.activity = []
+		self._time = None
+		self._commanded = False     # Whether a command or a read gave the pulse widths since it started
+		self.configure(channels_setup, ticks_per_step)
+		self.synced = None      # When the positions were read last time
+
+	def configure (self, channels_setup, ticks_per_step):
+		"""
+			Takes the ranges and inversions of the active channels, as uploaded. The firmware only centers the
+			channels in setup(), so they keep their pulse widths and movements, but they're unknown until the next
+			read. Until a command or a read is followed, they're taken as centered by setup()
+		"""
+		active = [v for v in channels_setup if v[0]]
+		self.ticks_per_step = ticks_per_step
+		self.ranges = [(arduino_map(r[0], 0, 255, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH),
+			arduino_map(r[1], 0, 255, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH)) for _, _, r, _ in active]
+		self.inverted = [bool(inverted) for _, _, _, inverted in active]
+		known = len(self.current) if self._commanded else 0
+		self.current = self.current[:len(self.ranges)] + [(low + high) >> 1 for low, high in self.ranges[known:]]
+		self.desired = self.desired[:len(self.ranges)] + self.current[known:]
+		self.delta = self.delta[:len(self.ranges)] + [0 for r in self.ranges[known:]]
+		self.activity = self.activity[:len(self.ranges)] + [0 for r in self.ranges[known:]]
+		self.synced = None
+
+	def command (self, channel, speed, pos, now):
+		"""
+			Applies a command for a channel, with speed 0-15 and position 0-255, received at the time given
+		"""
+		self.update(now)
+		if channel >= len(self.current):
+			return
+		self._commanded = True
+		if self.inverted[channel]:
+			pos = 255 - pos
+		low, high = self.ranges[channel]
+		self.activity[channel] = self.ticks_per_step << 3
+		self.desired[channel] = arduino_map(pos, 0, 255, low, high)
+		self.delta[channel] = trunc_div((self.desired[channel] - self.current[channel]) * (speed + 1), 16)
+
+	def update (self, now):
+		"""
+			Moves the channels by the ISR ticks between the last update and now
+		"""
+		if self._time is not None:
+			ticks = int(now / PERIOD) - int(self._time / PERIOD)
+			if ticks > 0:
+				for i in range(len(self.current)):
+					self._tick(i, ticks)
+		if self._time is None or now > self._time:
+			self._time = now
+
+	def _tick (self, i, ticks):
+		ticks = min(ticks, self.activity[i])
+		if not ticks:
+			return
+		self.activity[i] -= ticks
+		z, y = self.desired[i], self.delta[i]
+		if y == 0:
+			self.current[i] = z
+			return
+		moved = self.current[i] + y * ticks
+		if (y < 0 and moved <= z) or (y > 0 and moved >= z):
+			self.current[i] = z
+			self.delta[i] = 0
+		else:
+			self.current[i] = moved
+
+	def pulse_widths (self, now):
+		"""
+			Returns the pulse width (us) every active channel should have now
+		"""
+		self.update(now)
+		return list(self.current)
+
+	def positions (self, now):
+		"""
+			Returns the position (0-255, as given in commands) every active channel should be at now
+		"""
+		positions = []
+		for i, current in enumerate(self.pulse_widths(now)):
+			low, high = self.ranges[i]
+			pos = 255.0 * (current - low) / (high - low) if high != low else 0.0
+			positions.append(255.0 - pos if self.inverted[i] else pos)
+		return positions
+
+	def sync (self, reply, now):
+		"""
+			Corrects the positions with the ones read from the robot (MISC 0). The firmware only sends the low byte
+			of every pulse width, so the closest one to the prediction with that low byte is taken
+		"""
+		self.update(now)
+		for i, low_byte in enumerate(reply[:len(self.current)]):
+			predicted = self.current[i]
+			candidate = predicted - ((predicted - low_byte) & 0xff)
+			self.current[i] = min((candidate, candidate + 256), key = lambda c: abs(c - predicted))
+		self._commanded = True
+		self.synced = now
@@ -0,0 +1,126 @@
+# This module drives several robots from one process, doing the same in all of them at once
+
+from time import monotonic
+from gevent import spawn, joinall
+from gevent.event import AsyncResult
+from robot import Robot
+from connection import RobotConnection
+from timeline import Timeline
+
+class Fleet(object):
+	"""
+		Robots by name (the prefix of their configuration and programs), connected by the ports given, as in
+		Fleet({'tetra': '/dev/ttyUSB0', 'tetra3': 'bt://00:11:22:33:44:55'}), or a list of names to find them in the
+		usual ports. Every robot keeps its own connection and queues, and what's asked to the fleet is done in all
+		of them at the same time
+	"""
+
+	def __init__ (self, robots):
+		if not isinstance(robots, dict):
+			robots = {name: None for name in robots}
+		# Robots with a port of their own connect at once. The rest probe the same ports, so one after another, and
+		# only the ones no robot is connected by yet
+		connecting = {name: spawn(Robot, name, port) for name, port in robots.items() if port is not None}
+		joinall(list(connecting.values()), raise_error = True)
+		members = {name: greenlet.value for name, greenlet in connecting.items()}
+		for name in robots:
+			if name not in members:
+				members[name] = Robot(name, self._free_ports(members.values()))
+		self.robots = {name: members[name] for name in robots}
+		for robot in self.robots.values():
+			robot.load_config()
+		self._subscribers = {}
+
+	@staticmethod
+	def _free_ports (robots):
+		"""
+			Returns the usual ports but the ones the robots given are connected by
+		"""
+		used = set(robot._conn.device for robot in robots if robot._conn.is_connected())
+		return [port for port in RobotConnection.DEFAULT_PORTS if port not in used]
+
+	def __getitem__ (self, name):
+		return self.robots[name]
+
+	def __iter__ (self):
+		return iter(self.robots.values())
+
+	def _each (self, function):
+		"""
+			Calls function(robot) for every robot at the same time, and returns what it returned, by name
+		"""
+		greenlets = {name: spawn(function, robot) for name, robot in self.robots.items()}
+		joinall(list(greenlets.values()), raise_error = True)
+		return {name: greenlet.value for name, greenlet in greenlets.items()}
+
+	def upload_all (self, programs = None, upload_mode = 0):
+		"""
+			Loads the programs given (numbers) of every robot, or all the ones found for it, and uploads them to all
+			the robots at once, in RAM (0) or EEPROM (1). Returns the seconds every upload took, or None if it failed
+		"""
+		def upload (robot):
+			if programs is None:
+				robot.load_all()
+			else:
+				for program in programs:
+					robot.load(program)
+			sent = AsyncResult()
+			start = monotonic()
+			robot.upload_programs(upload_mode, sent)
+			return sent.get() - start if sent.get() is not None else None
+		start = monotonic()
+		seconds = self._each(upload)
+		print("Uploaded to %d robots in %.3f s" % (len(self.robots), monotonic() - start))
+		return seconds
+
+	def play_all (self, timeline):
+		"""
+			Plays a Timeline in every robot, starting at the same time, so each command reaches all of them at once:
+			every one is sent ahead by the latency measured for its robot. Returns the log of every robot, by name
+		"""
+		leads = self._each(lambda robot: robot.link_latency())
+		# No robot has to be late for the first commands
+		start = monotonic() + max(leads.values(), default = 0.0)
+		logs = self._each(lambda robot: robot.play(timeline, leads[robot.prefix], start))
+		for i, (at, label, _) in enumerate(timeline.commands):
+			arrivals = [logs[name][i][2] + leads[name] for name in logs if logs[name][i][2] is not None]
+			if len(arrivals) < len(logs):
+				print("Fleet %.3f %s: not sent to %d robots" % (at, label, len(logs) - len(arrivals)))
+			if arrivals:
+				print("Fleet %.3f %s: reached all robots within %.1f ms" % (at, label, (max(arrivals) - min(arrivals)) * 1000))
+		return logs
+
+	def run_all (self, program):
+		return self.play_all(Timeline().run(0, program))
+
+	def stop_all (self):
+		return self.play_all(Timeline().stop(0))
+
+	def start_telemetry (self, rate = 50.0, inputs = None, size = 4096):
+		return {name: robot.start_telemetry(rate, inputs, size) for name, robot in self.robots.items()}
+
+	def stop_telemetry (self):
+		for robot in self:
+			robot.stop_telemetry()
+
+	def subscribe_telemetry (self, callback):
+		"""
+			Calls callback(name, time, values) for every telemetry frame of any robot, as Robot.subscribe_telemetry
+		"""
+		self._subscribers[callback] = {}
+		for name, robot in self.robots.items():
+			self._subscribers[callback][name] = lambda time, values, name = name: callback(name, time, values)
+			robot.subscribe_telemetry(self._subscribers[callback][name])
+
+	def unsubscribe_telemetry (self, callback):
+		for name, subscriber in self._subscribers.pop(callback, {}).items():
+			self.robots[name].unsubscribe_telemetry(subscriber)
+
+	def telemetry_windows (self, frames = None, seconds = None):
+		"""
+			Returns (times, values) for the last telemetry frames of every robot, by name, as Robot.telemetry_window
+		"""
+		return {name: robot.telemetry_window(frames, seconds) for name, robot in self.robots.items()}
+
+	def metrics (self):
+		return {name: robot.metrics.snapshot() for name, robot in self.robots.items()}
@@ -0,0 +1,97 @@
+# This module keeps counters and timings of the link with a robot, to tell where the time goes
+
+import json
+from bisect import bisect_left
+from time import monotonic
+
+
+class Histogram(object):
+	"""
+		Distribution of durations in seconds, in buckets doubling from 100 us up to 13 s
+	"""
+
+	BOUNDS = [0.0001 * 2 ** i for i in range(18)]
+
+	def __init__ (self):
+		self.counts = [0 for i in range(len(self.BOUNDS) + 1)]
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def observe (self, value):
+		self.counts[bisect_left(self.BOUNDS, value)] += 1
+		self.count += 1
+		self.total += value
+		self.max = max(self.max, value)
+
+	def percentile (self, p):
+		"""
+			Upper bound of the bucket where the percentile p (0-100) falls, or the maximum if lower
+		"""
+		rank = self.count * p / 100.0
+		seen = 0
+		for i, count in enumerate(self.counts):
+			seen += count
+			if count and seen >= rank:
+				return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+		return 0.0
+
+	def snapshot (self):
+		return {
+			'count': self.count,
+			'mean': self.total / self.count if self.count else 0.0,
+			'max': self.max,
+			'p50': self.percentile(50),
+			'p90': self.percentile(90),
+			'p99': self.percentile(99),
+		}
+
+
+class Metrics(object):
+	"""
+		Counters, histograms of durations and gauges (functions giving the current value of something, like the
+		depth of a queue), by name
+	"""
+
+	def __init__ (self):
+		self.counters = {}
+		self.histograms = {}
+		self.gauges = {}
+		self._start = monotonic()
+		self._last = (self._start, {})
+
+	def incr (self, name, value = 1):
+		self.counters[name] = self.counters.get(name, 0) + value
+
+	def observe (self, name, seconds):
+		if name not in self.histograms:
+			self.histograms[name] = Histogram()
+		self.histograms[name].observe(seconds)
+
+	def gauge (self, name, function):
+		self.gauges[name] = function
+
+	def snapshot (self):
+		"""
+			Returns the value of every metric, and how fast every counter grew since the previous snapshot
+		"""
+		now = monotonic()
+		last_time, last_counters = self._last
+		counters = dict(self.counters)
+		elapsed = now - last_time
+		self._last = (now, counters)
+		return {
+			'uptime': now - self._start,
+			'counters': counters,
+			'rates': {name: (value - last_counters.get(name, 0)) / elapsed if elapsed > 0 else 0.0
+				for name, value in counters.items()},
+			'gauges': {name: function() for name, function in list(self.gauges.items())},
+			'histograms': {name: histogram.snapshot() for name, histogram in list(self.histograms.items())},
+		}
+
+	def dump (self, stream):
+		"""
+			Writes a snapshot as a line of JSON
+		"""
+		stream.write(json.dumps(self.snapshot(), sort_keys = True) + '\n')
+		stream.flush()
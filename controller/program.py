@@ -1,7 +1,17 @@
 
+import os
 import re
+import hashlib
+import zipfile
+from glob import glob
+import numpy as np
 from struct import pack, unpack
 from programmer import Programmer
+from programcode import ProgramCode, COMMAND_CHANNELS
+from rcparser import parse
+from protocol import OTHER_COMMAND, CONTROL_COMMAND, MISC_COMMAND
+
+PROGRAM_FILE = re.compile(r'_(\d+)\.rc$')     # Number of the program in the name of its file
 
 class RobotProgram(object):
 	"""        
@@ -13,24 +23,36 @@ class RobotProgram(object):
 		into the same program forever.
 	"""
 
-	OTHER_COMMAND = 253
-	CONTROL_COMMAND = 254
-	MISC_COMMAND = 255
+	OTHER_COMMAND = OTHER_COMMAND
+	CONTROL_COMMAND = CONTROL_COMMAND
+	MISC_COMMAND = MISC_COMMAND
+	CACHE_VERSION = 1               # Changes whenever the compiled code for the same source would change
 	
 	def __init__ (self, prefix = '', channels = []):
 		self.prefix = prefix or 'program'
-		self._code = []             # Stores the binary code for every program
+		self._code = []             # Stores the code for every program, as a ProgramCode, or None until it's used
 		self.all_channels = channels or []
+		self._digests = {}          # Hash of the source of every program, while it's the one of its code
+		self._compiled = None       # Compiled code by hash of source and channels, loaded from the cache file
+		self._cache_changed = False
+		self._library = None        # Time every program found in files was modified, by number, once scanned
+		self._loaded = {}           # Time the file of every program was modified, while its code is the one read
 
 	def get_command (self, program, step, channel):
 		"""
 			Gets a command inside a program, step and channel if any, else returns None
 		"""
-		if len(self._code) > program and len(self._code[program]) > step:
-			if channel in self._code[program][step]:
-				return self._code[program][step][channel]
-			
+		if len(self._code) > program:
+			if channel == 'comment':
+				return self._program_code(program).comments.get(step)
+			command = self._program_code(program).get(step, channel)
+			if command is not None:
+				return self._command_dict(command)
 		return None
+
+	@staticmethod
+	def _command_dict (command):
+		return {'s': int(command['speed']), 'm': int(command['mode']), 'v': int(command['value']), 'e': int(command['extra'])}
 		
 	def set_command (self, program, step, cmd, pos, extra = None):
 		"""
@@ -41,7 +63,9 @@ class RobotProgram(object):
 		
 		# Overwrite the channel with the new command
 		channel, speed, mode = self.unpack_command(cmd)
-		self._code[program][step][channel] = {'s': speed, 'm': mode, 'v': pos, 'e': extra}
+		self._code[program].set(step, channel, speed, mode, pos, extra)
+		self._digests.pop(program, None)
+		self._loaded.pop(program, None)
 
 	def set_comment (self, program, step, comment = ''):
 		"""
@@ -50,42 +74,81 @@ class RobotProgram(object):
 		self._ensure_program(program)
 		self._ensure_step(program, step)
 		
-		# Overwrite the channel with the new command
-		self._code[program][step]['comment'] = comment
+		self._code[program].comments[step] = comment
+		self._loaded.pop(program, None)
 	
 	def load (self, program):
 		"""
-			Returns the code of the program loaded
+			Loads the code of a program from its file
 		"""
-		with open(self.prefix+'_'+str(program)+".rc", 'r') as f:
-			data=f.read()
+		path = self._program_file(program)
+		with open(path, 'r') as f:
+			modified = os.fstat(f.fileno()).st_mtime
+			data = f.read()
 		self.set_program_source_code(program, data)
+		self._loaded[program] = modified
+		if self._library is not None:
+			self._library[program] = modified
+
+	def load_all (self, last = None):
+		"""
+			Adds the programs from 1 to last, or to the last one found, to the ones uploaded. Every one is loaded
+			from its file when it's first used, and loaded again if the file changes before an upload
+		"""
+		if last is None:
+			last = max(self.get_library(), default = 0)
+		self._ensure_program(last)
 		
 	def save (self, program):
 		"""
 			Save a program given into the memory
 		"""
 		data = self.get_program_source_code(program)
-		with open(self.prefix+'_'+str(program)+".rc", 'w') as f:
+		with open(self._program_file(program), 'w') as f:
 			f.write(data)
+			f.flush()
+			self._loaded[program] = os.fstat(f.fileno()).st_mtime
+		if self._library is not None:
+			self._library[program] = self._loaded[program]
+
+	def get_library (self):
+		"""
+			Returns the numbers of the programs found in files, looking for them only the first time
+		"""
+		if self._library is None:
+			self._library = {}
+			for path in glob('%s_*.rc' % self.prefix):
+				match = PROGRAM_FILE.search(path)
+				if match and path == self._program_file(int(match.group(1))):
+					self._library[int(match.group(1))] = os.path.getmtime(path)
+		return sorted(self._library)
+
+	def _program_file (self, program):
+		return '%s_%d.rc' % (self.prefix, program)
+
+	def _refresh (self):
+		"""
+			Loads again the programs whose files changed since they were loaded, unless they were edited here
+		"""
+		for program, modified in list(self._loaded.items()):
+			try:
+				changed = os.path.getmtime(self._program_file(program)) != modified
+			except OSError:
+				continue
+			if changed:
+				self.load(program)
 
 	def get_program_source_code (self, program):
 		"""
 			Returns a printable version of the code for a program number
 		"""
-		self._ensure_program(program)
-
+		code = self._program_code(program)
+		steps = [[] for i in range(code.steps)]
+		for command in code.step_commands():
+			steps[command['step']].append(self.get_command_source_code(program, int(command['channel']), self._command_dict(command)))
 		source_code = ''
-		for step, channels in enumerate(self._code[program]):
-			commands = []
-			comment = ''
-			for channel, command in channels.items():
-				if channel == 'comment':
-					comment = self.get_command(program, step, channel)
-					continue
-				command = self.get_command(program, step, channel)
-				if command:
-					commands.append(self.get_command_source_code(program, channel, command))
+		for step, commands in enumerate(steps):
+			comment = code.comments.get(step, '')
 			if comment:
 				comment = '\t\t# %s' % comment if commands else '# %s' % comment
 			source_code += "%s%s\n" % (" ".join(commands), comment)
@@ -97,7 +160,9 @@ class RobotProgram(object):
 			code = ap.get_raw_code()
 			if code or seed:
 				self._ensure_program(program)
-				self._code[program] = code
+				self._code[program] = ProgramCode.from_steps(code)
+				self._digests.pop(program, None)
+				self._loaded.pop(program, None)
 				break
 		if loop:
 			self.set_command(program, steps, RobotProgram.CONTROL_COMMAND, program)
@@ -105,75 +170,15 @@ class RobotProgram(object):
 			self.set_command(program, steps, RobotProgram.CONTROL_COMMAND, 0)
 					   
 	def set_program_source_code (self, program, program_code=''):
+		"""
+			Replaces a program by the one in the source code given. Raises ProgramSyntaxError, a ValueError with
+			the line and column, if it's wrong
+		"""
 		self._ensure_program(program)
-		self._code[program] = []
-		for i, line_raw in enumerate(program_code.split("\n")):
-			if '#' in line_raw:
-				line, comment = line_raw.split('#', 1)
-				line = line.strip()
-				comment = comment.strip()
-			else:
-				line = line_raw.strip()
-				comment = ''
-			if line or comment:
-				step = i
-				self._ensure_step(program, step)
-			if line:
-				channels_str = line
-				for j in channels_str.split():
-					if j.startswith('sleep'):
-						pr = int(j[5:])
-						self.set_command(program, step, RobotProgram.OTHER_COMMAND, 0, pr-1)
-					elif j.startswith('jump'):
-						pr = int(j[4:])
-						self.set_command(program, step, RobotProgram.OTHER_COMMAND, 1, pr)
-					elif j.startswith('jleft'):
-						pr = int(j[5:])
-						self.set_command(program, step, RobotProgram.OTHER_COMMAND, 2, pr)
-					elif j.startswith('jright'):
-						pr = int(j[6:])
-						self.set_command(program, step, RobotProgram.OTHER_COMMAND, 3, pr)
-					elif j.startswith('jrand'):
-						pr = int(j[5:])
-						self.set_command(program, step, RobotProgram.OTHER_COMMAND, 4, pr)
-					elif j.startswith('ticks'):
-						pr = int(j[5:])
-						self.set_command(program, step, RobotProgram.OTHER_COMMAND, 5, pr-1)
-					elif j.startswith('stop'):
-						self.set_command(program, step, RobotProgram.CONTROL_COMMAND, 0)
-					elif j.startswith('run'):
-						pr = int(j[3:])
-						self.set_command(program, step, RobotProgram.CONTROL_COMMAND, pr)
-					elif j.startswith('restart'):
-						pr = program
-						self.set_command(program, step, RobotProgram.CONTROL_COMMAND, pr)
-					elif j[:1].upper() in self.all_channels:
-						channel = self.all_channels.index(j[:1].upper())
-						m = re.split("(\d{0,3})(:?s\d{1,2})?(:?m\d)?", j[1:], 0, re.IGNORECASE)
-						if m and len(m) > 1:
-							pos = int(m[1])
-							speed = 0
-							mode = 0
-							for k in m[2:]:
-								if not k:
-									continue
-								if k[:1]=='m':
-									mode = int(k[1:])-1
-									if not (0 <= mode <= 3):
-										raise ValueError("Invalid mode in "+str(j))
-								elif k[:1]=='s':
-									speed = int(k[1:])-1
-									if not (0 <= speed <= 15):
-										raise ValueError("Invalid speed in "+str(j))
-							cmd = self.pack_command(channel, speed, mode)
-							self.set_command(program, step, cmd, pos)
-						else:
-							raise ValueError("Invalid format in "+str(j))
-					else:
-						raise ValueError("Unknown command "+str(j))
-			if comment:
-				self.set_comment(program, step, comment)
-			
+		self._code[program] = parse(program_code, program, self.all_channels)
+		self._digests[program] = hashlib.sha1(program_code.encode()).hexdigest()
+		self._loaded.pop(program, None)
+
 	def get_command_source_code (self, program, channel, command):
 		if not command:
 			raise ValueError("Invalid command")
@@ -220,32 +225,54 @@ class RobotProgram(object):
 		self.set_program_source_code(program, '')
 
 	def get_program_raw_code (self, program, channels_lut):
-		raw_code = []
+		return self._compile_program(program, channels_lut)[1].tolist()
+
+	def _compile_program (self, program, channels_lut):
+		"""
+			Returns the key and the compiled code of a program, as a NumPy array, from the cache if its source and
+			the channels in use are the same as the last time it was compiled
+		"""
+		# Commands for OTHER and CONTROL keep their channel, and the ones for disabled channels are left out
+		lut = [channels_lut.get(channel, channel if channel >= len(self.all_channels) else -1)
+			for channel in range(COMMAND_CHANNELS)]
+		if self._compiled is None:
+			self._load_cache()
+		if program not in self._digests:
+			# Edited since it was loaded, so its source has to be written again to know if it changed
+			self._digests[program] = hashlib.sha1(self.get_program_source_code(program).encode()).hexdigest()
+		key = hashlib.sha1(("%d %d %s %s" % (RobotProgram.CACHE_VERSION, program, self._digests[program], lut)).encode()).hexdigest()
+		if key not in self._compiled:
+			self._compiled[key] = self._program_code(program).compile(lut)
+			self._cache_changed = True
+		return key, self._compiled[key]
+
+	def _cache_file (self):
+		return self.prefix + '.rcc'
+
+	def _load_cache (self):
+		"""
+			Loads the code compiled for the last upload, stored next to the source of the programs
+		"""
+		self._compiled = {}
+		try:
+			with np.load(self._cache_file()) as cache:
+				self._compiled = {key: cache[key] for key in cache.files}
+		except (IOError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+			# Missing, truncated or from elsewhere, so everything is compiled again
+			self._compiled = {}
 
-		for step, channels in enumerate(self._code[program]):
-			commands = []
-			for channel, command in channels.items():
-				if channel=='comment':
-					continue
-				command = self.get_command(program, step, channel)
-				if command and (channel in channels_lut or channel >= len(self.all_channels)):
-					cmd = self.pack_command(
-						channels_lut[channel] if channel in channels_lut else channel,
-						command['s'],
-						command.get('m', 0))
-					if cmd == RobotProgram.OTHER_COMMAND:
-						v = command.get('e', 0) & 0b11111
-						if command['v'] in (1, 2, 3, 4):	 # convert parameter to unsigned
-							v += 16
-						v += command['v'] << 5
-					else:
-						v = command['v']
-					commands.extend((cmd, v))
-			if commands:
-				raw_code.extend(commands)
-			#if channel < len(self.all_channels):
-			raw_code.append(255)    # Next step mark
-		return raw_code
+	def _save_cache (self, keys):
+		"""
+			Stores the code compiled for the programs given (their keys), dropping the rest
+		"""
+		self._compiled = {key: self._compiled[key] for key in keys}
+		try:
+			with open(self._cache_file() + '.tmp', 'wb') as f:
+				np.savez(f, **self._compiled)
+			os.replace(self._cache_file() + '.tmp', self._cache_file())
+		except IOError:
+			pass
+		self._cache_changed = False
 
 	def get_all_raw_code (self, ticks_per_step = 4, channels_setup = None):
 		"""
@@ -276,15 +303,22 @@ class RobotProgram(object):
 		channels_inverted = [v[3] for i, v in enumerate(channels_setup) if v[0]]
 		channels_lut = {k: channels_in_use.index(k) for k, _ in enumerate(self.all_channels) if k in channels_in_use}
 		
-		# Iterate over the programs, and get everything packed, with a header for the beginning of every program
-		# Fill gaps loading the source code from files
-		lengths = []
-		programs_code = []
+		# Iterate over the programs, and get everything packed, with a header for the beginning of every program.
+		# Only the ones changed since they were last compiled are compiled again, the rest are just put together
+		self._refresh()
+		if self._compiled is None:
+			self._load_cache()
+		keys = []
+		programs_raw = []
 		for program, _ in enumerate(self._code):
-			program_raw = self.get_program_raw_code(program, channels_lut)
-			if program_raw:
-				lengths.append(len(program_raw))
-				programs_code.extend(program_raw)
+			key, program_raw = self._compile_program(program, channels_lut)
+			keys.append(key)
+			if len(program_raw):
+				programs_raw.append(program_raw)
+		if self._cache_changed or len(self._compiled) != len(set(keys)):
+			self._save_cache(keys)
+		lengths = [len(program_raw) for program_raw in programs_raw]
+		programs_code = np.concatenate(programs_raw).tolist() if programs_raw else []
 
 		raw_code = [RobotProgram.MISC_COMMAND]    # Upload misc command (255)
 		
@@ -334,17 +368,23 @@ class RobotProgram(object):
 		return channel, speed, mode
 
 	def _ensure_program (self, program):
+		"""
+			Makes room for the programs up to the one given, to be loaded when they're used
+		"""
 		if len(self._code) <= program:
-			for i in range(program+1):
-				if len(self._code) <= i:
-					self._code.insert(i, [])
-					try:
-						self.load(program)
-					except:
-						pass
+			self._code.extend([None] * (program + 1 - len(self._code)))
+
+	def _program_code (self, program):
+		"""
+			Returns the code of a program, loading it from its file, if there's one, the first time
+		"""
+		self._ensure_program(program)
+		if self._code[program] is None:
+			if program in self.get_library():
+				self.load(program)
+			else:
+				self._code[program] = ProgramCode()
+		return self._code[program]
 
 	def _ensure_step (self, program, step):
-		if len(self._code[program]) <= step:
-			for i in range(step+1):
-				if len(self._code[program]) <= i:
-					self._code[program].insert(i, {})
+		self._program_code(program).ensure_step(step)
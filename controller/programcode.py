@@ -0,0 +1,124 @@
+# This module keeps the code of a program in NumPy arrays, so long or many programs are cheap to hold and compile
+
+import numpy as np
+from protocol import OTHER_COMMAND
+
+COMMAND_CHANNELS = 16               # Channels in a command (4 bits), including OTHER and CONTROL (13 and 14)
+END_OF_STEP = 255
+
+COMMAND = np.dtype([
+	('step', '<u2'),
+	('channel', 'u1'),
+	('speed', 'u1'),
+	('mode', 'u1'),
+	('value', '<i2'),
+	('extra', '<i2'),
+])
+
+
+class ProgramCode(object):
+	"""
+		Commands of a program, a row of `commands` for every one, in the order they were given, and comments by
+		step. `index` gives the row of the command for every step and channel, or -1. Both arrays grow by doubling,
+		so only the first `count` rows and `steps` steps are in use
+	"""
+
+	def __init__ (self, capacity = 16):
+		self.commands = np.zeros(capacity, dtype = COMMAND)
+		self.index = np.full((capacity, COMMAND_CHANNELS), -1, dtype = np.int32)
+		self.count = 0
+		self.steps = 0
+		self.comments = {}
+
+	@classmethod
+	def from_steps (cls, steps):
+		"""
+			Returns the code given as a list of steps, every one {channel: {'s': speed, 'm': mode, 'v': value,
+			'e': extra}}, as Programmer.get_raw_code gives it
+		"""
+		code = cls(max(len(steps), 1))
+		for step, channels in enumerate(steps):
+			code.ensure_step(step)
+			for channel, command in channels.items():
+				if channel == 'comment':
+					code.comments[step] = command
+				else:
+					code.set(step, channel, command.get('s', 0), command.get('m', 0), command.get('v', 0),
+						command.get('e'))
+		return code
+
+	@classmethod
+	def from_commands (cls, commands, steps, comments = None):
+		"""
+			Returns the code for the commands given as {(step, channel): (speed, mode, value, extra)}, in order
+		"""
+		code = cls(max(len(commands), 1))
+		code.ensure_step(steps - 1)
+		if commands:
+			rows = [key + command for key, command in commands.items()]
+			code.commands[:len(rows)] = np.array(rows, dtype = COMMAND)
+			code.count = len(rows)
+			code.index[code.commands['step'][:code.count], code.commands['channel'][:code.count]] = np.arange(code.count)
+		code.comments = comments or {}
+		return code
+
+	def ensure_step (self, step):
+		"""
+			Adds empty steps up to the one given
+		"""
+		if step >= len(self.index):
+			index = np.full((max(step + 1, 2 * len(self.index)), COMMAND_CHANNELS), -1, dtype = np.int32)
+			index[:len(self.index)] = self.index
+			self.index = index
+		self.steps = max(self.steps, step + 1)
+
+	def get (self, step, channel):
+		"""
+			Returns the row of the command for a step and channel, or None
+		"""
+		if step < self.steps and 0 <= channel < COMMAND_CHANNELS and self.index[step, channel] >= 0:
+			return self.commands[self.index[step, channel]]
+		return None
+
+	def set (self, step, channel, speed, mode, value, extra = None):
+		"""
+			Inserts or overwrites the command for a step and channel. A command overwritten keeps its place
+		"""
+		self.ensure_step(step)
+		row = self.index[step, channel]
+		if row < 0:
+			if self.count == len(self.commands):
+				self.commands = np.resize(self.commands, 2 * len(self.commands))
+			row = self.index[step, channel] = self.count
+			self.count += 1
+		self.commands[row] = (step, channel, speed, mode, value, extra or 0)
+
+	def step_commands (self):
+		"""
+			Returns the rows in use sorted by step, in the order they were given within every step
+		"""
+		commands = self.commands[:self.count]
+		return commands[np.argsort(commands['step'], kind = 'stable')]
+
+	def compile (self, channels_lut):
+		"""
+			Returns the bytes of the program as the firmware runs it, as a NumPy array, where channels_lut has the
+			number of every channel among the active ones, the channel itself for OTHER and CONTROL, or -1 for the
+			disabled channels, whose commands are left out
+		"""
+		commands = self.step_commands()
+		channels = np.asarray(channels_lut)[commands['channel']]
+		commands, channels = commands[channels >= 0], channels[channels >= 0]
+		cmd = (commands['speed'].astype(np.int32) << 4) | channels
+		value = commands['value'].astype(np.int32)
+		# OTHER commands take the subcommand in the 3 upper bits and the parameter in the rest, jumps offset by 16
+		other = cmd == OTHER_COMMAND
+		subcmd = value[other]
+		value[other] = (subcmd << 5) + (commands['extra'][other] & 0b11111) + np.where((subcmd >= 1) & (subcmd <= 4), 16, 0)
+
+		raw = np.full(2 * len(commands) + self.steps, END_OF_STEP, dtype = np.uint8)
+		# Every command goes after the ones before it and the end of every step before its own
+		positions = 2 * np.arange(len(commands)) + commands['step']
+		raw[positions] = cmd
+		raw[positions + 1] = value
+		return raw
@@ -0,0 +1,362 @@
+# This module keeps the details of the serial protocol with the robot that don't depend on how it's connected
+
+import yaml
+
+DEFAULT_PORTS = ["/dev/rfcomm1", "/dev/rfcomm0", "/dev/ttyUSB0", "/dev/ttyUSB1", "/dev/ttyUSB4", "/dev/ttyUSB5"]
+BAUD_RATE = 57600
+BYTE_TIME = 10.0 / BAUD_RATE    # Start bit, 8 data bits and stop bit
+RX_BUFFER = 64                  # Serial receive buffer in the Arduino
+MAX_OUTPUTS = 16                # Channels that can be configured in the header of an upload (4 bits)
+
+OTHER_COMMAND = 253
+CONTROL_COMMAND = 254
+MISC_COMMAND = 255
+
+# Subcommands for MISC_COMMAND
+MISC_GET_POSITIONS = 0
+MISC_GET_SENSORS = 1
+MISC_GET_FEATURES = 2
+MISC_TELEMETRY = 3
+MISC_UPLOAD_EEPROM_CREDITS = 251
+MISC_UPLOAD_RAM_CREDITS = 252
+MISC_UPLOAD_EEPROM = 253
+MISC_LOAD_EEPROM = 254
+MISC_UPLOAD_RAM = 255
+MISC_UPLOADS = (MISC_UPLOAD_EEPROM_CREDITS, MISC_UPLOAD_RAM_CREDITS, MISC_UPLOAD_EEPROM, MISC_UPLOAD_RAM)
+
+# Features reported by the firmware (MISC_GET_FEATURES)
+FEATURE_UPLOAD_CREDITS = 1
+FEATURE_TELEMETRY = 2
+
+# MISC_TELEMETRY is followed by a mask of the analog inputs to send (bit 0 for A0, 0 stops it) and the period in ms.
+# Then the firmware pushes a frame every period: TELEMETRY_FRAME plus the number of inputs, the time in ms (2 bytes,
+# little endian, wrapping around) and the value of every input (0-255). Replies are never that long
+TELEMETRY_FRAME = 0x80
+TELEMETRY_INPUTS = 6
+
+# During uploads with credits, the firmware sends UPLOAD_CREDIT every time it has read UPLOAD_CREDIT_SIZE bytes,
+# and UPLOAD_DONE when the whole upload has been stored
+UPLOAD_CREDIT = 6
+UPLOAD_DONE = 4
+UPLOAD_CREDIT_SIZE = 32
+
+EEPROM_WRITE_TIME = 0.0034      # Time taken by the firmware to store every byte in EEPROM (EEPROM.update())
+
+# Servos are moved by the ISR every PERIOD (PERIOD_IN_USECS), with pulse widths (us) between these, for 0-255
+PERIOD = 0.02
+MIN_PULSE_WIDTH = 600
+MAX_PULSE_WIDTH = 2400
+
+
+def encode (cmd, params):
+	"""
+		Returns the bytes to send a command, followed by one parameter or a list of them
+	"""
+	if isinstance(params, int):
+		return bytes((cmd, params))
+	return bytes([cmd] + list(params))
+
+
+def arduino_map (x, in_min, in_max, out_min, out_max):
+	"""
+		Same as map() in Arduino, using integer arithmetic truncated towards zero
+	"""
+	num = (x - in_min) * (out_max - out_min)
+	den = in_max - in_min
+	q = abs(num) // abs(den)
+	if (num < 0) != (den < 0):
+		q = -q
+	return q + out_min
+
+
+def trunc_div (num, den):
+	"""
+		Integer division truncated towards zero, as in C
+	"""
+	q = abs(num) // abs(den)
+	return -q if (num < 0) != (den < 0) else q
+
+class LinkModel(object):
+	"""
+		Models how full the receive buffer of the Arduino is, from the bytes written to it, the speed of the line
+		and the time the firmware takes to consume every byte. Used to pace writes when the firmware can't tell.
+		While it's held, the firmware is taken as busy (i.e. answering a read), so it doesn't consume any
+	"""
+
+	def __init__ (self, byte_cost = 0.0, baud_rate = BAUD_RATE, buffer_size = RX_BUFFER):
+		self.byte_time = max(10.0 / baud_rate, byte_cost)
+		self.buffer_size = buffer_size
+		self._level = 0.0
+		self._time = 0.0
+		self._holds = 0
+
+	def level (self, now):
+		"""
+			Bytes written but not consumed yet
+		"""
+		if self._holds:
+			return self._level
+		return max(0.0, self._level - (now - self._time) / self.byte_time)
+
+	def hold (self, now):
+		self._level = self.level(now)
+		self._time = now
+		self._holds += 1
+
+	def release (self, now):
+		self._level = self.level(now)
+		self._time = now
+		self._holds = max(0, self._holds - 1)
+
+	def wait_time (self, length, now):
+		"""
+			Seconds to wait before `length` bytes more can be written without overflowing the buffer
+		"""
+		excess = self.level(now) + min(length, self.buffer_size) - self.buffer_size
+		return max(0.0, excess * self.byte_time)
+
+	def drain_time (self, now):
+		"""
+			Seconds until every byte written has been consumed
+		"""
+		return self.level(now) * self.byte_time
+
+	def add (self, length, now):
+		self._level = self.level(now) + length
+		self._time = now
+
+
+class FrameParser(object):
+	"""
+		Splits the bytes received from the robot into replies, as they come. Every reply starts by its length
+		in one byte, followed by that many bytes. Telemetry frames are given to on_telemetry as they complete,
+		as (time in ms, values), or dropped if it's None
+	"""
+
+	def __init__ (self, on_telemetry = None):
+		self.on_telemetry = on_telemetry
+		self.reset()
+
+	def reset (self):
+		"""
+			Drops any reply partially received
+		"""
+		self._frame = None
+		self._length = 0
+		self._telemetry = False
+
+	def feed (self, data):
+		"""
+			Returns the list of replies completed by the bytes given
+		"""
+		frames = []
+		i = 0
+		while i < len(data):
+			if self._frame is None:
+				self._start(data[i])
+				i += 1
+			i = self._take(data, i)
+			if len(self._frame) == self._length:
+				if not self._telemetry:
+					frames.append(self._frame)
+				self._complete()
+		return frames
+
+	def strip (self, data):
+		"""
+			Same as feed, while uploading, when the firmware only sends single bytes (credits), that are returned
+		"""
+		rest = bytearray()
+		i = 0
+		while i < len(data):
+			if self._frame is None:
+				if data[i] < TELEMETRY_FRAME:
+					rest.append(data[i])
+					i += 1
+					continue
+				self._start(data[i])
+				i += 1
+			i = self._take(data, i)
+			if len(self._frame) == self._length:
+				self._complete()
+		return bytes(rest)
+
+	def _start (self, length):
+		self._telemetry = length >= TELEMETRY_FRAME
+		# Telemetry frames carry the time before the values
+		self._length = length - TELEMETRY_FRAME + 2 if self._telemetry else length
+		self._frame = []
+
+	def _take (self, data, i):
+		take = self._length - len(self._frame)
+		self._frame.extend(data[i:i + take])
+		return i + take
+
+	def _complete (self):
+		frame, self._frame = self._frame, None
+		if self._telemetry and self.on_telemetry:
+			self.on_telemetry(frame[0] | frame[1] << 8, frame[2:])
+
+
+class CommandParser(object):
+	"""
+		Splits the bytes sent to the robot into commands, as the firmware reads them. Every command takes two
+		bytes, except telemetry, that takes the mask and period too, and uploads, that go on with the header and
+		the programs given by RobotProgram.get_all_raw_code
+	"""
+
+	def __init__ (self):
+		self.reset()
+
+	def reset (self):
+		self._command = bytearray()
+		self._length = 2
+
+	def pending (self):
+		"""
+			Returns the bytes of the command partially received
+		"""
+		return bytes(self._command)
+
+	def feed (self, data):
+		"""
+			Returns the list of commands completed by the bytes given
+		"""
+		commands = []
+		i = 0
+		while i < len(data):
+			take = self._length - len(self._command)
+			self._command.extend(data[i:i + take])
+			i += take
+			if len(self._command) == self._length:
+				self._length = self._command_length(self._command)
+				if len(self._command) == self._length:
+					commands.append(bytes(self._command))
+					self.reset()
+		return commands
+
+	@staticmethod
+	def _command_length (command):
+		if command[0] == MISC_COMMAND and command[1] == MISC_TELEMETRY:
+			return 4
+		if command[0] != MISC_COMMAND or command[1] not in MISC_UPLOADS:
+			return 2
+		if len(command) < 6:
+			return 6
+		# Length of offsets and code, number of programs, ticks and outputs, ranges and inverted mask
+		outputs = (command[5] & 15) + 1
+		return 2 + 2 + (command[2] | command[3] << 8) + 2 + 2 * outputs + 2
+
+
+class Handshake(object):
+	"""
+		Finds whether a robot is on a port, by asking for the position of the channels (REQUEST) until it answers.
+		The parser stays in sync with the bytes received, so the connection goes on with it once the robot is found
+	"""
+
+	REQUEST = bytes((MISC_COMMAND, MISC_GET_POSITIONS))
+
+	def __init__ (self):
+		self.parser = FrameParser()
+
+	def feed (self, data):
+		"""
+			Returns whether the bytes received complete a reply from the robot
+		"""
+		# The firmware sends a position for every channel in use
+		return any(1 <= len(frame) <= MAX_OUTPUTS for frame in self.parser.feed(data))
+
+
+class Upload(object):
+	"""
+		Bytes to write to upload the configuration and programs, as given by RobotProgram.get_all_raw_code, starting
+		by the subcommand to store them in RAM (255) or EEPROM (253), without overflowing the 64-byte receive buffer
+		in the Arduino. When the firmware grants credits (features), they pace the bytes written, otherwise the link
+		model, with the time the firmware takes to store every byte
+	"""
+
+	def __init__ (self, data, features, baud_rate = BAUD_RATE):
+		data = bytes(data)
+		self.to_eeprom = data[0] == MISC_UPLOAD_EEPROM
+		self.mode = 'credits' if features & FEATURE_UPLOAD_CREDITS else 'timing'
+		if self.mode == 'credits':
+			subcmd = MISC_UPLOAD_EEPROM_CREDITS if self.to_eeprom else MISC_UPLOAD_RAM_CREDITS
+			self.data = bytes((MISC_COMMAND, subcmd)) + data[1:]
+		else:
+			self.data = bytes((MISC_COMMAND, )) + data
+		self.link = LinkModel(EEPROM_WRITE_TIME if self.to_eeprom else 0.0, baud_rate)
+		self.sent = 0
+		self._credits = 0
+
+	def chunks (self, size):
+		"""
+			Returns the bytes to write in chunks of the size given, to pace them by the link model
+		"""
+		return [self.data[start:start + size] for start in range(0, len(self.data), size)]
+
+	def allowed (self):
+		"""
+			Returns the next bytes to write, as much as the credits granted allow, and takes them as sent
+		"""
+		allowed = RX_BUFFER + self._credits * UPLOAD_CREDIT_SIZE - self.sent
+		chunk = self.data[self.sent:self.sent + max(allowed, 0)]
+		self.sent += len(chunk)
+		return chunk
+
+	def received (self, data):
+		"""
+			Takes the bytes received with credits. Returns None until the firmware is done, and then whether it got
+			everything
+		"""
+		self._credits += data.count(UPLOAD_CREDIT)
+		if UPLOAD_DONE in data:
+			return self.sent == len(self.data)
+		return None
+
+	def stats (self, seconds):
+		"""
+			Returns the size, time and throughput of the upload, once done, and prints them
+		"""
+		stats = {
+			'bytes': len(self.data),
+			'seconds': seconds,
+			'rate': len(self.data) / seconds,
+			'mode': self.mode,
+			'target': 'EEPROM' if self.to_eeprom else 'RAM',
+		}
+		print("Uploaded %(bytes)d bytes to %(target)s in %(seconds).3f s (%(rate).0f B/s, paced by %(mode)s)" % stats)
+		return stats
+
+
+def ports_to_probe (name, ports, path = 'ports.conf'):
+	"""
+		Returns the groups of ports to probe in turn, all the ports of a group at the same time: first where the robot
+		with the name given was found last time, then every other
+	"""
+	last_port = load_last_port(name, path)
+	if last_port in ports:
+		return [[last_port], [d for d in ports if d != last_port]]
+	return [list(ports)]
+
+
+def load_last_port (name, path = 'ports.conf'):
+	"""
+		Returns the port where the robot with the name given was found last time, if any
+	"""
+	try:
+		with open(path, 'r') as f:
+			return (yaml.safe_load(f) or {}).get(name)
+	except IOError:
+		return None
+
+
+def save_last_port (name, device, path = 'ports.conf'):
+	try:
+		with open(path, 'r') as f:
+			last_ports = yaml.safe_load(f) or {}
+	except IOError:
+		last_ports = {}
+	if last_ports.get(name) != device:
+		last_ports[name] = device
+		with open(path, 'w') as f:
+			f.write(yaml.safe_dump(last_ports, default_flow_style=False))
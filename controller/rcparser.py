@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# This module parses the source code of programs (.rc files) into their code, in a single pass. Every line of a
+# program is a step, with commands separated by spaces and an optional comment after #.
+# Usage: python3 rcparser.py [steps], to measure how fast it parses a generated program
+
+import re
+import sys
+import random
+import timeit
+from programcode import ProgramCode
+from protocol import OTHER_COMMAND, CONTROL_COMMAND
+
+TOKENS = re.compile(r"""
+	(?P<newline>\n)
+	| \#(?P<comment>[^\n]*)
+	| (?: (?P<keyword>sleep|jump|jleft|jright|jrand|ticks|run)(?P<number>[-+]?\d+)
+		| (?P<stop>stop)
+		| (?P<restart>restart)
+		| (?P<channel>[A-Za-z])(?P<pos>\d{1,3})
+			(?: [sS](?P<speed>\d{1,2}) (?:[mM](?P<mode>\d))? | [mM](?P<mode2>\d) (?:[sS](?P<speed2>\d{1,2}))? )?
+	  ) (?=[\s\#]|$)
+	| (?P<error>[^\s\#]+)
+""", re.VERBOSE)
+
+# Subcommand of OTHER_COMMAND for every keyword, the range of its number, and what's stored (the number minus it)
+OTHER_KEYWORDS = {
+	'sleep': (0, 1, 32, 1),
+	'jump': (1, -16, 15, 0),
+	'jleft': (2, -16, 15, 0),
+	'jright': (3, -16, 15, 0),
+	'jrand': (4, -16, 15, 0),
+	'ticks': (5, 1, 32, 1),
+}
+
+
+class ProgramSyntaxError(ValueError):
+	"""
+		Error in the source code of a program, at the line and column given (from 1)
+	"""
+
+	def __init__ (self, message, line, column, token = ''):
+		ValueError.__init__(self, "Line %d, column %d: %s" % (line, column, message))
+		self.line = line
+		self.column = column
+		self.token = token
+
+
+def _syntax_error (message, match, group, line, line_start):
+	token = match.group(0)
+	return ProgramSyntaxError(message + " in " + token, line + 1, match.start(group) - line_start + 1, token)
+
+
+def parse (source, program, channels):
+	"""
+		Returns the ProgramCode for the source code of a program, where channels are the names of the channels
+		(uppercase letters). Raises ProgramSyntaxError at the first error
+	"""
+	# Commands by step and channel, where a later one overwrites an earlier one in its place
+	commands = {}
+	comments = {}
+	steps = 0
+	channel_numbers = {name: i for i, name in enumerate(channels)}
+	line = 0
+	line_start = 0
+	# Spaces between tokens are skipped by the search, as every other character starts a token
+	for match in TOKENS.finditer(source):
+		kind = match.lastgroup
+		if kind == 'newline':
+			line += 1
+			line_start = match.end()
+			continue
+		if kind == 'comment':
+			comment = match.group('comment').strip()
+			if comment:
+				steps = line + 1
+				comments[line] = comment
+			continue
+
+		steps = line + 1
+		if match.group('channel'):
+			channel = channel_numbers.get(match.group('channel').upper())
+			if channel is None:
+				raise _syntax_error("Unknown channel", match, 0, line, line_start)
+			pos = int(match.group('pos'))
+			if pos > 255:
+				raise _syntax_error("Invalid position", match, 'pos', line, line_start)
+			# Speed and mode can come in any order
+			speed_group = 'speed' if match.group('speed') else 'speed2'
+			mode_group = 'mode' if match.group('mode') else 'mode2'
+			speed, mode = match.group(speed_group), match.group(mode_group)
+			if speed and not 1 <= int(speed) <= 16:
+				raise _syntax_error("Invalid speed", match, speed_group, line, line_start)
+			if mode and not 1 <= int(mode) <= 4:
+				raise _syntax_error("Invalid mode", match, mode_group, line, line_start)
+			commands[line, channel] = (int(speed) - 1 if speed else 0, int(mode) - 1 if mode else 0, pos, 0)
+		elif match.group('keyword') == 'run':
+			number = int(match.group('number'))
+			if not 0 <= number <= 255:
+				raise _syntax_error("Invalid program", match, 'number', line, line_start)
+			commands[line, CONTROL_COMMAND & 15] = (15, 0, number, 0)
+		elif match.group('keyword'):
+			subcmd, low, high, offset = OTHER_KEYWORDS[match.group('keyword')]
+			number = int(match.group('number'))
+			if not low <= number <= high:
+				raise _syntax_error("Expected %d to %d" % (low, high), match, 'number', line, line_start)
+			commands[line, OTHER_COMMAND & 15] = (15, 0, subcmd, number - offset)
+		elif match.group('stop'):
+			commands[line, CONTROL_COMMAND & 15] = (15, 0, 0, 0)
+		elif match.group('restart'):
+			commands[line, CONTROL_COMMAND & 15] = (15, 0, program, 0)
+		else:
+			raise _syntax_error("Unknown command", match, 0, line, line_start)
+	return ProgramCode.from_commands(commands, steps, comments)
+
+
+def generate_source (steps, channels, seed = None):
+	"""
+		Returns the source of a program with a position for every channel in every step, as generated ones are
+	"""
+	rand = random.Random(seed)
+	lines = []
+	for step in range(steps):
+		commands = ['%s%d' % (channel, rand.randrange(256)) for channel in channels]
+		commands = [command + 's%d' % rand.randrange(1, 17) if rand.random() < 0.5 else command for command in commands]
+		lines.append(' '.join(commands) + ('\t\t# Step %d' % step if step % 10 == 0 else ''))
+	lines.append('restart')
+	return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+	channels = ['Q', 'W', 'E', 'A', 'S', 'D', 'R', 'T', 'Y', 'F', 'G', 'H']
+	for steps in [int(sys.argv[1])] if len(sys.argv) > 1 else [10, 100, 1000, 10000]:
+		source = generate_source(steps, channels, seed = 1)
+		runs = max(1, 10000 // steps)
+		seconds = min(timeit.repeat(lambda: parse(source, 1, channels), number = runs, repeat = 3)) / runs
+		print("%6d steps, %7d bytes: %8.3f ms (%.0f steps/s)" % (steps, len(source), seconds * 1000, steps / seconds))
@@ -2,194 +2,507 @@
 import sys
 import struct
 from gevent import sleep, spawn, Timeout
+from gevent.event import Event, AsyncResult
 import copy
-import yaml
+import numpy as np
+from time import monotonic
+from collections import deque
 from program import RobotProgram
-from connection import RobotConnection
+from robotbase import RobotBase
+from connection import RobotConnection, Reply
+from protocol import encode, MISC_UPLOADS, MISC_TELEMETRY, TELEMETRY_INPUTS, FEATURE_TELEMETRY
+from estimator import ServoEstimator
+from telemetry import TelemetryBuffer
 
 """
    Robot interface
 """
 
-class Robot(object):
+class Robot(RobotBase):
+	"""
+		Robot connected by the port given, as a device, an URL (serial://, tcp://, bt://, loop://) or a list of them.
+		By default, it looks for it in the usual serial ports. The traffic with it is recorded in the capture file
+		given, if any, that can be replayed later with port='replay://file'
+	"""
 
-	CHANNELS = ['Q', 'W', 'E', 'A', 'S', 'D', 'R', 'T', 'Y', 'F', 'G', 'H']
+	# Commands waiting are sent by priority: control (run, stop, telemetry...), reads, positions of the channels and
+	# uploads. Positions and uploads also wait while the firmware has more than MAX_BACKLOG seconds of bytes to read,
+	# so a stop never waits longer than that behind them (uploads can't be interrupted once started). Control commands
+	# given after an upload wait for it, so a program run after uploading it is the new one
+	MAX_BACKLOG = 0.005
+	PLAY_TIMEOUT = 10.0             # Longest a command of a timeline waits to be written, once all were given
 
-	def __init__ (self, prefix=''):
+	# Names of the MISC commands in the latency metrics, besides run, other, upload and channel.<name>
+	MISC_OPCODES = {0: 'positions', 1: 'sensors', 2: 'features', MISC_TELEMETRY: 'telemetry', 254: 'load'}
 
+	def __init__ (self, prefix='', port=None, capture=None):
+		RobotBase.__init__(self, prefix)
 		self.read_lock = False
-		self.send_commands_flag = True
-		self.ticks_per_step = 6
-		self.prefix = prefix
-		# Keeps (active, is_servo, ranges, is_inverted) for every channel num
-		self._channels_setup = [(1, 1, (0, 255), 0) for i in Robot.CHANNELS]
-		# Queue of channels + one special for control, misc and other commands
-		self._channel_commands = [[] for i in range(len(Robot.CHANNELS)+1)]
-		self._positions = []
-		self._sensors = []
-		self.program = RobotProgram(self.prefix, Robot.CHANNELS)
-		self._conn = RobotConnection()
+		# Last command for every channel, and channels with a command not sent yet, since when
+		self._channel_commands = [None for i in Robot.CHANNELS]
+		self._dirty = {}
+		self._channels_sent = {}    # Results to set to the time the next command for every channel is sent
+		# Queues for control (run, other, load from EEPROM, telemetry), reads and uploads, as (cmd, params, reply or None, time)
+		self._control_commands = deque()
+		self._reads = deque()
+		self._bulk = deque()
+		self._wakeup = Event()
+		self._conn = RobotConnection(ports=port, name=self.prefix, capture=capture)
+		# Counters and timings of the link, and commands waiting to be sent
+		self.metrics = self._conn.metrics
+		self.metrics.gauge('queue.channels', lambda: len(self._dirty))
+		self.metrics.gauge('queue.control', lambda: len(self._control_commands))
+		self.metrics.gauge('queue.reads', lambda: len(self._reads))
+		self.metrics.gauge('queue.bulk', lambda: len(self._bulk))
+		# Prediction of the positions from the commands sent, and last read to correct it
+		self.estimator = ServoEstimator(self._channels_setup, self.ticks_per_step)
+		self._resync = None
+		# Last frames pushed by the robot, if telemetry was started, and callbacks for every new one
+		self.telemetry = None
+		self._telemetry_subscribers = []
+		self._conn.on_telemetry = self._telemetry_frame
 		self._running = True
 		self._process_commands = spawn(self._process_commands_loop)
 		sleep(0) # yields
-
-	def load_config (self, suffix = ''):
-		custom = {}
-		try:
-			with open('%s%s.conf' % (self.prefix, suffix), 'r') as f:
-				config = yaml.load(f, Loader=yaml.FullLoader)
-				self.send_commands_flag = config['send_commands_flag']
-				self.ticks_per_step = config['ticks_per_step']
-				self._channels_setup = config['channels_setup']
-				custom = config.get('custom') or {}
-		except IOError as e:
-			pass
-		return custom
-			
-	def save_config (self, suffix = '', custom = {}):
-		with open('%s%s.conf' % (self.prefix, suffix), 'w') as f:
-			config = {
-				'send_commands_flag': self.send_commands_flag,
-				'ticks_per_step': self.ticks_per_step,
-				'channels_setup': self._channels_setup,
-				'custom': custom,
-			}
-			f.write(yaml.dump(config))
-
-	def load (self, program):
-		self.program.load(program)                
-
-	def save (self, program):
-		self.program.save(program)                
 		
-	def run (self, program):
+	def run (self, program, sent = None):
 		"""
-			Run program 0 means stop, otherwise, starts the execution of the program number given (1-255)
+			Run program 0 means stop, otherwise, starts the execution of the program number given (1-255).
+			sent, if given, is an AsyncResult set to the time it's written to the robot
 		"""
-		self._request(-1, RobotProgram.CONTROL_COMMAND, program)
+		self._request(-1, RobotProgram.CONTROL_COMMAND, program, sent)
 	
 	def stop (self):
 		self.run(0)
 
-	def set_code (self, program, code=''):
-		self.program.set_program_source_code(program, code)
-		
-	def get_code (self, program):
-		return self.program.get_program_source_code(program)
-
-	def generate_code (self, program, seed = None, steps = 12, types_subset = None):
-		self.program.generate_code(program, channels_setup = self._channels_setup, seed = seed, steps = steps, types_subset = types_subset)
+	def load_config (self, suffix = ''):
+		custom = RobotBase.load_config(self, suffix)
+		self.estimator.configure(self._channels_setup, self.ticks_per_step)
+		return custom
 
-	def upload_programs (self, upload_mode = 0):
+	def upload_programs (self, upload_mode = 0, sent = None):
 		"""
 			Upload all the programs to the robot
 			upload_mode selects if programs will be stored in RAM (0), or in EEPROM (1) 
+			sent, if given, is set to the time the upload ended, or to None if the robot didn't store it
 		"""
-		raw, length = self.program.get_all_raw_code(self.ticks_per_step, self._channels_setup)
-		# If upload mode is EEPROM, change the first byte from 255 to 253
-		if upload_mode:
-			raw[0] = 253
-		print("About to upload", length,"bytes", "to EEPROM" if upload_mode else "to RAM")
-		print(raw)
-		# Saves the raw programs in an accesible location
-		#with open('/home/drone/public_html/robot/programs.json', 'w') as f:
-		#	f.write(str([255] + raw))
-		self._request(-1, RobotProgram.MISC_COMMAND, raw)
+		self._request(-1, RobotProgram.MISC_COMMAND, self._get_upload_code(upload_mode), sent)
 	
-	def set_position (self, program, step, channel, speed, mode, pos):
+	def set_position (self, program, step, channel, speed, mode, pos, sent = None):
 		"""
-			Set the position for a channel
+			Set the position for a channel. sent, if given, is set to the time it's written, as in run(), or to None
+			at once if the channel is disabled, as nothing is sent then
 		"""
-		if not isinstance(channel, int):
-			channel = Robot.CHANNELS.index(channel.upper())
+		channel_cmd = self._set_position_command(program, step, channel, speed, mode, pos)
+		if channel_cmd:
+			channel, cmd = channel_cmd
+			self._request(channel, cmd, pos, sent)
+		elif sent is not None and not sent.ready():
+			sent.set(None)
 
-		channels_in_use = [i for i, v in enumerate(self._channels_setup) if v[0] ]
-		channels_lut = {k: channels_in_use.index(k) for k, _ in enumerate(Robot.CHANNELS) if k in channels_in_use}
-		if channel in channels_lut:
-			cmd = self.program.pack_command(channel, speed, mode)
-			cmd_alt = self.program.pack_command(channels_lut[channel] if channel in channels_lut else channel, speed, mode)
-			self._request(channel, cmd_alt, pos)
-			self.program.set_command(program, step, cmd, pos)
+	def stream (self, trajectory, rate = 50.0, channels = None, speed = 15):
+		"""
+			Moves the channels from the host through a trajectory, a (steps x channels) array of positions (0-255),
+			a row every 1/rate seconds, instead of running a program uploaded (i.e. Programmer.get_raw_data(),
+			transposed). Every row is sent at its deadline since the start, so delays don't add up, and rows whose
+			deadline passed while a later one is due are skipped. channels gives the channel of every column (names
+			or numbers), by default the active ones in order. Returns how many rows were sent and skipped, and the
+			jitter (seconds from their deadlines until they were given to the robot)
+		"""
+		trajectory = np.asarray(trajectory, dtype = np.uint8)
+		channels_lut = self._channels_lut()
+		if channels is None:
+			channels = sorted(channels_lut)
+		channels = [c if isinstance(c, int) else Robot.CHANNELS.index(c.upper()) for c in channels]
+		if trajectory.ndim != 2 or trajectory.shape[1] != len(channels):
+			raise ValueError("The trajectory needs a column for every one of the %d channels" % len(channels))
+		if any(c not in channels_lut for c in channels):
+			raise ValueError("Disabled channels can't be moved")
+		commands = [self.program.pack_command(channels_lut[c], speed) for c in channels]
+
+		period = 1.0 / rate
+		jitter = []
+		skipped = 0
+		start = monotonic()
+		step = 0
+		while step < len(trajectory):
+			# Last row whose deadline has passed
+			due = int((monotonic() - start) / period)
+			if due > step:
+				skipped += min(due, len(trajectory)) - step
+				step = due
+				if step >= len(trajectory):
+					break
+			deadline = start + step * period
+			if deadline > monotonic():
+				# Check again after waking up, in case it took longer
+				sleep(deadline - monotonic())
+				continue
+			late = monotonic() - deadline
+			jitter.append(late)
+			self.metrics.observe('stream.jitter', late)
+			for channel, cmd, pos in zip(channels, commands, trajectory[step]):
+				self._request(channel, cmd, int(pos))
+			step += 1
+		return {
+			'sent': len(jitter),
+			'skipped': skipped,
+			'jitter_mean': sum(jitter) / len(jitter) if jitter else 0.0,
+			'jitter_max': max(jitter) if jitter else 0.0,
+		}
 
-	def setup_channel (self, channel, active = None, is_servo = None, min_range = None, max_range = None, inverted = None):
+	def play (self, timeline, lead = None, start = None):
 		"""
-		   Configure a channel as being active or disabled, and also defines the type of pwm for 
-		   the channel (servo or pure pwm)
+			Gives the commands of a Timeline to the robot at their times by the monotonic clock, each one lead seconds
+			earlier to make up for the time it takes to reach the robot (link_latency() by default). Waits until all
+			of them are written, printing when, and returns (time, label, sent, drift) for every one, with the time
+			it was written since the start and how late it was, also kept in the timeline.drift metric. Both are None
+			for the commands not sent (i.e. poses of disabled channels), or not written within PLAY_TIMEOUT.
+			The timeline starts now, or at the monotonic time given, to play it in several robots at once
 		"""
-		if not isinstance(channel, int):
-			channel = Robot.CHANNELS.index(channel.upper())
-		
-		self._channels_setup[channel] = (
-			active if active is not None else self._channels_setup[channel][0],
-			is_servo if is_servo is not None else self._channels_setup[channel][1],
-			(
-				min_range if min_range is not None else self._channels_setup[channel][2][0],
-				max_range if max_range is not None else self._channels_setup[channel][2][1]
-			),
-			inverted if inverted is not None else self._channels_setup[channel][3],
-		)
-		#print("Channels setup", self._channels_setup)
-
-	def get_positions (self):
-		self._request(-1, RobotProgram.MISC_COMMAND, 0)
-		while self._positions == []:
-			sleep(0.1)
-		if self._positions is None:
+		if lead is None:
+			lead = self.link_latency()
+		def report (sent, at, label):
+			if sent.value is None:
+				print("Timeline %s %.3f %s: not sent" % (self.prefix, at, label))
+			else:
+				print("Timeline %s %.3f %s: sent at %.3f" % (self.prefix, at, label, sent.value - start))
+		if start is None:
+			start = monotonic()
+		results = []
+		for at, label, action in timeline.commands:
+			due = start + at - lead
+			while monotonic() < due:
+				sleep(due - monotonic())
+			sent = AsyncResult()
+			sent.rawlink(lambda sent, at = at, label = label: report(sent, at, label))
+			action(self, sent)
+			results.append(sent)
+		log = []
+		for (at, label, _), sent in zip(timeline.commands, results):
+			try:
+				written = sent.get(timeout = self.PLAY_TIMEOUT)
+			except Timeout:
+				written = None
+			if written is None:
+				log.append((at, label, None, None))
+				continue
+			time = written - start
+			drift = time - (at - lead)
+			self.metrics.observe('timeline.drift', abs(drift))
+			log.append((at, label, time, drift))
+		return log
+
+	def link_latency (self):
+		"""
+			Seconds a command takes from being given until the robot has it, by the metrics: the mean time waiting to
+			be sent, plus half the mean round trip of reads. The positions are read to measure it if never done
+		"""
+		histograms = self.metrics.histograms
+		if 'rtt.positions' not in histograms:
+			self.get_positions()
+		def mean (name):
+			histogram = histograms.get(name)
+			return histogram.total / histogram.count if histogram and histogram.count else 0.0
+		return mean('latency.control') + mean('rtt.positions') / 2
+
+	def predict_positions (self, resync = 1.0):
+		"""
+			Returns the position (0-255) every active channel should be at now, following the commands sent as the
+			firmware does, without waiting for the robot. When the positions were read longer than resync seconds
+			ago (or a program was run since), they are read in the background to correct the prediction
+		"""
+		now = monotonic()
+		synced = self.estimator.synced
+		if resync is not None and (synced is None or now - synced > resync):
+			if self._resync is None or self._resync.ready():
+				self._resync = self.request_positions()
+		return self.estimator.positions(now)
+
+	def request_positions (self, timeout = 2.0):
+		"""
+			Asks for the position of every channel in use, and returns a Reply, a future set to them as soon as they
+			are received (get() waits for it), or to None if they don't come before timeout or it's cancelled
+		"""
+		reply = Reply(timeout)
+		self._request(-1, RobotProgram.MISC_COMMAND, 0, reply)
+		return reply
+
+	def request_sensors (self, timeout = 2.0):
+		"""
+			Same as request_positions, for the value of the sensors
+		"""
+		reply = Reply(timeout)
+		self._request(-1, RobotProgram.MISC_COMMAND, 1, reply)
+		return reply
+
+	def get_positions (self, timeout = 2.0):
+		positions = self._wait_reply(self.request_positions(timeout), timeout)
+		if positions is None:
 			print("Error reading positions")
-		return self._positions
+		return positions
 
-	def get_sensors (self):
-		self._request(-1, RobotProgram.MISC_COMMAND, 1)
-		while self._sensors == []:
-			sleep(0.1)
-		if self._sensors is None:
+	def get_sensors (self, timeout = 2.0):
+		sensors = self._wait_reply(self.request_sensors(timeout), timeout)
+		if sensors is None:
 			print("Error reading sensors")
-		return self._sensors
+		return sensors
+
+	def _wait_reply (self, reply, timeout):
+		# Gives up if the read can't even be sent in time (i.e. while reconnecting)
+		if not reply.wait(timeout + 1.0):
+			reply.cancel()
+		return reply.get()
+
+	def start_telemetry (self, rate = 50.0, inputs = None, size = 4096):
+		"""
+			Makes the robot push the value of the analog inputs given (0-5, all by default) rate times per second
+			(4-1000), without waiting to be asked, and returns the TelemetryBuffer where the last `size` frames are
+			kept, also in self.telemetry. Raises ValueError if the firmware doesn't support it
+		"""
+		inputs = sorted(set(range(TELEMETRY_INPUTS) if inputs is None else inputs))
+		if not inputs or any(i not in range(TELEMETRY_INPUTS) for i in inputs):
+			raise ValueError("Telemetry needs analog inputs between 0 and %d" % (TELEMETRY_INPUTS - 1))
+		if not self.supports_telemetry():
+			raise ValueError("Telemetry is not supported by the robot")
+		period = min(max(int(round(1000.0 / rate)), 1), 255)
+		self.telemetry = TelemetryBuffer(inputs, size)
+		self._request(-1, RobotProgram.MISC_COMMAND, [MISC_TELEMETRY, sum(1 << i for i in inputs), period])
+		return self.telemetry
+
+	def supports_telemetry (self):
+		"""
+			Returns whether the firmware can push telemetry. Raises IOError if the robot is not connected
+		"""
+		return bool(self._conn.get_features() & FEATURE_TELEMETRY)
 
-	def _request (self, channel, cmd, params):
-		self._channel_commands[channel].append((cmd, params))
+	def stop_telemetry (self):
+		self._request(-1, RobotProgram.MISC_COMMAND, [MISC_TELEMETRY, 0, 0])
+
+	def subscribe_telemetry (self, callback):
+		"""
+			Calls callback(time, values) for every telemetry frame, as it comes, with its time in seconds by the
+			clock of the robot and the value of every input. It runs in the greenlet reading from the robot, so it
+			must not block
+		"""
+		self._telemetry_subscribers.append(callback)
+
+	def unsubscribe_telemetry (self, callback):
+		if callback in self._telemetry_subscribers:
+			self._telemetry_subscribers.remove(callback)
+
+	def telemetry_window (self, frames = None, seconds = None):
+		"""
+			Returns (times, values) for the last telemetry frames, as TelemetryBuffer.window does
+		"""
+		if self.telemetry is None:
+			raise ValueError("Telemetry was not started")
+		return self.telemetry.window(frames, seconds)
+
+	def _telemetry_frame (self, millis, values):
+		frame = self.telemetry.append(millis, values) if self.telemetry is not None else None
+		if frame is not None:
+			for callback in list(self._telemetry_subscribers):
+				callback(*frame)
+
+	def latency_breakdown (self):
+		"""
+			Returns the latency of the commands sent, by opcode (run, positions, sensors, upload, channel.Q...) and
+			stage: queue (waiting to be sent), write (including the waits for the firmware to make room), response
+			(from written until the reply was parsed, only for reads) and total, as Histogram.snapshot() gives them
+		"""
+		breakdown = {}
+		for name, histogram in list(self.metrics.histograms.items()):
+			if name.startswith('command.'):
+				opcode, stage = name[len('command.'):].rsplit('.', 1)
+				breakdown.setdefault(opcode, {})[stage] = histogram.snapshot()
+		return breakdown
+
+	def dump_metrics (self, interval = 10.0, path = None):
+		"""
+			Writes a snapshot of the metrics as a line of JSON every interval, to the file given (appended) or to the
+			standard output. Returns the greenlet doing it, to kill it when no longer needed
+		"""
+		def dump_loop ():
+			stream = open(path, 'a') if path else sys.stdout
+			try:
+				while True:
+					sleep(interval)
+					self.metrics.dump(stream)
+			finally:
+				if path:
+					stream.close()
+		return spawn(dump_loop)
+
+	def connection_events (self):
+		"""
+			Yields (state, error) every time the connection with the robot is lost ('disconnected'), is being
+			recovered ('reconnecting') or is back ('connected'). Commands given meanwhile are kept, only the last
+			one for every channel, and sent when the robot is back
+		"""
+		queue = self._conn.subscribe()
+		try:
+			while True:
+				yield queue.get()
+		finally:
+			self._conn.unsubscribe(queue)
+
+	def _request (self, channel, cmd, params, reply = None):
+		"""
+			Queues a command. reply is the Reply for reads, or an AsyncResult set to the time any other is sent
+		"""
+		if channel != -1:
+			# Only the last command given to a channel is sent
+			self._channel_commands[channel] = (cmd, params)
+			self._dirty.setdefault(channel, monotonic())
+			if reply is not None:
+				self._channels_sent.setdefault(channel, []).append(reply)
+		elif cmd == RobotProgram.MISC_COMMAND and params in (0, 1):
+			self._reads.append((cmd, params, reply, monotonic()))
+		elif cmd == RobotProgram.MISC_COMMAND and isinstance(params, (tuple, list)) and params[0] in MISC_UPLOADS:
+			self._bulk.append((cmd, params, reply, monotonic()))
+		else:
+			self._control_commands.append((cmd, params, reply, monotonic()))
+		self._wakeup.set()
 
 	def _process_commands_loop (self):
 		"""
-			Sends every last command given to a channel and drops the previous ones
+			Sends the commands waiting one after another, by priority, as fast as the link allows, and sleeps until
+			there are more. The commands for all the channels pending are written at once, so they start moving
+			together. While the robot is not connected, they wait for it
 		"""
 		while self._running:
-			if self._conn._read_lock:
-				sleep(0.01)
+			self._wakeup.clear()
+			if not (self._control_commands or self._reads or self._dirty or self._bulk):
+				self._wakeup.wait()
+				continue
+			if not self._conn.wait_connected(timeout = 1.0):
 				continue
-			for i, commands in enumerate(self._channel_commands):
-				if commands:
-					cmd, params = commands[-1]
-					#if self._channel_commands[i][:-1]:
-					#    print("Skipping ", self._channel_commands[i][:-1])
-					self._channel_commands[i] = []    # Deletes all pending commands from the channel
-					# Send commands optionally for legs and trunk, but allow control commands always
-					if self.send_commands_flag or i >= len(self.CHANNELS):
-						if i >= len(self.CHANNELS) or i == -1:        # Handles control commands and misc commands
-							if cmd in (RobotProgram.CONTROL_COMMAND, RobotProgram.OTHER_COMMAND):
-								self._conn.send(cmd, params)
-							elif cmd == RobotProgram.MISC_COMMAND:
-								if isinstance(params, (tuple, list)):
-									subcmd = params[0]
-								else:
-									subcmd = params
-								if subcmd == 0:           # READ POSITIONS	
-									self._conn.send(cmd, subcmd)
-									self._positions = self._conn.recv()
-								elif subcmd == 1:         # READ SENSORS
-									self._conn.send(cmd, subcmd)
-									#print('Sent', cmd, subcmd)
-									self._sensors = self._conn.recv()
-								elif subcmd in (253, 254, 255):       # UPLOAD CONFIGURATION
-									# Writes all the programs and configuration at once
-									#print("Writing programs to the robot")
-									#print(pos)
-									self._conn.send(cmd, params, flush=1)
-									print("Done")
-						else:
-							print("Send", cmd, params)
-							#print("Channel",cmd & 15, "Speed", (cmd >> 4))
-							self._conn.send(cmd, params)
-					sleep(0.01)
-
-			sleep(0.01)
+			try:
+				if self._control_commands and not self._after_upload(self._control_commands[0]):
+					self._send_next(self._control_commands, 'control')
+				elif self._reads:
+					self._send_next(self._reads, 'read')
+				elif self._conn.backlog() > self.MAX_BACKLOG:
+					# Leave the link free for anything more urgent that comes meanwhile
+					self._wakeup.wait(self._conn.backlog() - self.MAX_BACKLOG)
+				elif self._dirty:
+					dirty, self._dirty = self._dirty, {}
+					channels = sorted(dirty)
+					dequeued = monotonic()
+					try:
+						self._send_channels([self._channel_commands[channel] for channel in channels])
+					except IOError:
+						# Send them again when the robot is back, or the commands that replaced them meanwhile
+						for channel, since in dirty.items():
+							self._dirty[channel] = min(since, self._dirty.get(channel, since))
+						raise
+					now = monotonic()
+					for channel, since in dirty.items():
+						self.metrics.observe('latency.setpoint', now - since)
+						self._observe_command('channel.' + Robot.CHANNELS[channel], since, dequeued, now)
+					for channel in channels:
+						for sent in self._channels_sent.pop(channel, []):
+							if not sent.ready():
+								sent.set(now)
+				elif self._bulk and self._conn.reads_pending():
+					# Replies coming during an upload would be taken for its credits
+					self._conn.wait_reads(timeout = 1.0)
+				elif self._bulk:
+					self._send_next(self._bulk, 'bulk')
+			except IOError as e:
+				print("Error sending", e)
+
+	def _after_upload (self, command):
+		"""
+			Returns whether a command was given after an upload not sent yet
+		"""
+		return bool(self._bulk) and self._bulk[0][3] <= command[3]
+
+	def _send_next (self, queue, priority):
+		command = queue.popleft()
+		cmd, params, reply, queued = command
+		dequeued = monotonic()
+		try:
+			self._send_control(cmd, params, reply)
+		except IOError:
+			queue.appendleft(command)
+			raise
+		now = monotonic()
+		self.metrics.observe('latency.' + priority, now - queued)
+		if isinstance(reply, Reply):
+			# Reads are kept when their reply comes, unless they were cancelled before being sent
+			if reply.sent:
+				opcode = self._opcode(cmd, params)
+				reply.rawlink(lambda reply: self._observe_command(opcode, queued, dequeued, reply.sent[1], reply.received))
+		else:
+			self._observe_command(self._opcode(cmd, params), queued, dequeued, now)
+			if reply is not None and not reply.ready():
+				reply.set(now)
+
+	def _sync_positions (self, reply):
+		if reply.value:
+			self.estimator.sync(reply.value, reply.received)
+
+	@staticmethod
+	def _opcode (cmd, params):
+		if cmd == RobotProgram.CONTROL_COMMAND:
+			return 'run'
+		if cmd == RobotProgram.OTHER_COMMAND:
+			return 'other'
+		subcmd = params[0] if isinstance(params, (tuple, list)) else params
+		if subcmd in MISC_UPLOADS:
+			return 'upload'
+		return Robot.MISC_OPCODES.get(subcmd, 'misc.%d' % subcmd)
+
+	def _observe_command (self, opcode, queued, dequeued, written, received = None):
+		"""
+			Keeps how long a command waited to be sent, took to be written and, for reads, to be answered, in the
+			command.<opcode>.<stage> metrics
+		"""
+		name = 'command.' + opcode
+		self.metrics.observe(name + '.queue', dequeued - queued)
+		self.metrics.observe(name + '.write', written - dequeued)
+		if received is not None:
+			self.metrics.observe(name + '.response', received - written)
+		self.metrics.observe(name + '.total', (received or written) - queued)
+
+	def _send_channels (self, commands):
+		# Send commands optionally for legs and trunk, but allow control commands always
+		if self.send_commands_flag:
+			if self.debug_commands_flag:
+				for cmd, params in commands:
+					print("Send", cmd, params)
+			self._conn.write(b''.join(encode(cmd, params) for cmd, params in commands))
+			now = monotonic()
+			for cmd, params in commands:
+				self.estimator.command(cmd & 15, cmd >> 4, params, now)
+
+	def _send_control (self, cmd, params, reply):
+		if cmd in (RobotProgram.CONTROL_COMMAND, RobotProgram.OTHER_COMMAND):
+			self._conn.send(cmd, params)
+			# Programs move the channels on their own
+			self.estimator.synced = None
+		elif cmd == RobotProgram.MISC_COMMAND:
+			if isinstance(params, (tuple, list)):
+				subcmd = params[0]
+			else:
+				subcmd = params
+			if subcmd in (0, 1):      # READ POSITIONS or SENSORS
+				if not reply.ready():     # Unless it was cancelled meanwhile
+					# The reply is matched when it comes, while the next commands are sent
+					self._conn.request(subcmd, reply)
+					if subcmd == 0:
+						reply.rawlink(self._sync_positions)
+			elif subcmd == MISC_TELEMETRY:
+				if not self._conn.set_telemetry(*params[1:]):
+					print("Telemetry is not supported by the robot")
+			elif subcmd == 254:       # LOAD CONFIGURATION FROM EEPROM
+				self._conn.send(cmd, subcmd)
+				self.estimator.synced = None
+			elif subcmd in (253, 255):       # UPLOAD CONFIGURATION
+				# Writes all the programs and configuration at once
+				if self._conn.upload(params) is not None:
+					self.estimator.configure(self._channels_setup, self.ticks_per_step)
+				elif reply is not None:
+					reply.set(None)
@@ -0,0 +1,125 @@
+import yaml
+from program import RobotProgram
+
+"""
+   Parts of the robot interface that don't depend on how commands are sent (gevent or asyncio)
+"""
+
+class RobotBase(object):
+
+	CHANNELS = ['Q', 'W', 'E', 'A', 'S', 'D', 'R', 'T', 'Y', 'F', 'G', 'H']
+
+	def __init__ (self, prefix=''):
+		self.send_commands_flag = True
+		self.debug_commands_flag = False    # Prints every command for the channels sent
+		self.ticks_per_step = 6
+		self.prefix = prefix
+		# Keeps (active, is_servo, ranges, is_inverted) for every channel num
+		self._channels_setup = [(1, 1, (0, 255), 0) for i in RobotBase.CHANNELS]
+		self.program = RobotProgram(self.prefix, RobotBase.CHANNELS)
+
+	def load_config (self, suffix = ''):
+		custom = {}
+		try:
+			with open('%s%s.conf' % (self.prefix, suffix), 'r') as f:
+				config = yaml.load(f, Loader=yaml.FullLoader)
+				self.send_commands_flag = config['send_commands_flag']
+				self.ticks_per_step = config['ticks_per_step']
+				self._channels_setup = config['channels_setup']
+				custom = config.get('custom') or {}
+		except IOError as e:
+			pass
+		return custom
+
+	def save_config (self, suffix = '', custom = {}):
+		with open('%s%s.conf' % (self.prefix, suffix), 'w') as f:
+			config = {
+				'send_commands_flag': self.send_commands_flag,
+				'ticks_per_step': self.ticks_per_step,
+				'channels_setup': self._channels_setup,
+				'custom': custom,
+			}
+			f.write(yaml.dump(config))
+
+	def load (self, program):
+		self.program.load(program)
+
+	def load_all (self, last = None):
+		self.program.load_all(last)
+
+	def save (self, program):
+		self.program.save(program)
+
+	def set_code (self, program, code=''):
+		self.program.set_program_source_code(program, code)
+
+	def get_code (self, program):
+		return self.program.get_program_source_code(program)
+
+	def generate_code (self, program, seed = None, steps = 12, types_subset = None):
+		self.program.generate_code(program, channels_setup = self._channels_setup, seed = seed, steps = steps, types_subset = types_subset)
+
+	def setup_channel (self, channel, active = None, is_servo = None, min_range = None, max_range = None, inverted = None):
+		"""
+		   Configure a channel as being active or disabled, and also defines the type of pwm for
+		   the channel (servo or pure pwm)
+		"""
+		if not isinstance(channel, int):
+			channel = RobotBase.CHANNELS.index(channel.upper())
+
+		self._channels_setup[channel] = (
+			active if active is not None else self._channels_setup[channel][0],
+			is_servo if is_servo is not None else self._channels_setup[channel][1],
+			(
+				min_range if min_range is not None else self._channels_setup[channel][2][0],
+				max_range if max_range is not None else self._channels_setup[channel][2][1]
+			),
+			inverted if inverted is not None else self._channels_setup[channel][3],
+		)
+		#print("Channels setup", self._channels_setup)
+
+	def _get_upload_code (self, upload_mode = 0):
+		"""
+			Returns the raw code to upload all the programs to the robot, in RAM (0) or in EEPROM (1)
+		"""
+		raw, length = self.program.get_all_raw_code(self.ticks_per_step, self._channels_setup)
+		# If upload mode is EEPROM, change the first byte from 255 to 253
+		if upload_mode:
+			raw[0] = 253
+		print("About to upload", length,"bytes", "to EEPROM" if upload_mode else "to RAM")
+		print(raw)
+		# Saves the raw programs in an accesible location
+		#with open('/home/drone/public_html/robot/programs.json', 'w') as f:
+		#	f.write(str([255] + raw))
+		return raw
+
+	def is_active (self, channel):
+		"""
+			Returns whether a channel, by name or number, is in use
+		"""
+		if not isinstance(channel, int):
+			channel = RobotBase.CHANNELS.index(channel.upper())
+		return channel in self._channels_lut()
+
+	def _channels_lut (self):
+		"""
+			Returns the number of every active channel among the active ones, as the firmware numbers them
+		"""
+		channels_in_use = [i for i, v in enumerate(self._channels_setup) if v[0]]
+		return {k: i for i, k in enumerate(channels_in_use)}
+
+	def _set_position_command (self, program, step, channel, speed, mode, pos):
+		"""
+			Sets the position for a channel in the program and step given, and returns the channel and the command
+			to send to the robot, where channels are numbered among the active ones. Returns None for disabled channels
+		"""
+		if not isinstance(channel, int):
+			channel = RobotBase.CHANNELS.index(channel.upper())
+
+		channels_lut = self._channels_lut()
+		if channel in channels_lut:
+			cmd = self.program.pack_command(channel, speed, mode)
+			cmd_alt = self.program.pack_command(channels_lut[channel] if channel in channels_lut else channel, speed, mode)
+			self.program.set_command(program, step, cmd, pos)
+			return channel, cmd_alt
+		return None
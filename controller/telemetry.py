@@ -0,0 +1,51 @@
+# This module keeps the telemetry pushed by the robot, to be read by windows without asking for it
+
+import numpy as np
+
+
+class TelemetryBuffer(object):
+	"""
+		Ring buffer with the last `size` telemetry frames, in arrays allocated once: times, in seconds by the clock
+		of the robot since the first frame, and values (0-255) of the analog inputs given, a column for every one.
+		The time in frames wraps around every 65.536 s, so frames can't be missing for longer than that
+	"""
+
+	def __init__ (self, inputs, size = 4096):
+		self.inputs = list(inputs)
+		self.times = np.zeros(size, dtype = np.float64)
+		self.values = np.zeros((size, len(self.inputs)), dtype = np.uint8)
+		self.count = 0              # Frames received since it was created
+		self._millis = None
+		self._elapsed = 0
+
+	def __len__ (self):
+		return min(self.count, len(self.times))
+
+	def append (self, millis, values):
+		"""
+			Stores a frame, as given by the firmware, and returns its (time, values), or None if it doesn't have
+			a value for every input (sent before the inputs were changed)
+		"""
+		if len(values) != len(self.inputs):
+			return None
+		if self._millis is not None:
+			self._elapsed += (millis - self._millis) & 0xffff
+		self._millis = millis
+		i = self.count % len(self.times)
+		self.times[i] = self._elapsed / 1000.0
+		self.values[i] = values
+		self.count += 1
+		return float(self.times[i]), self.values[i].copy()
+
+	def window (self, frames = None, seconds = None):
+		"""
+			Returns (times, values) for the last number of frames given, or the ones received in the last seconds
+			by the clock of the robot, or all of them, oldest first. They are copies, kept after new frames come
+		"""
+		n = len(self) if frames is None else min(frames, len(self))
+		rows = (self.count - n + np.arange(n)) % len(self.times)
+		times, values = self.times[rows], self.values[rows]
+		if seconds is not None and n:
+			first = np.searchsorted(times, times[-1] - seconds)
+			times, values = times[first:], values[first:]
+		return times, values
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from robot import Robot
+from timeline import Timeline
 from gevent import sleep
 
 tetra = Robot('tetra3')
@@ -8,30 +9,22 @@ tetra.ticks_per_step = 10
 tetra.setup_channel('E', active = False)
 tetra.setup_channel('S', active = False)
 tetra.setup_channel('D', active = False)
-for i in range(12):  # Load programs
-    tetra.load(i+1)
+tetra.load_all(12)  # Load programs
 tetra.upload_programs()
 sleep(10)
-tetra.run(5)
-print("Move leg...")
-tetra.set_position(0, 1, 0, 0, 0, 240); sleep(2)
-tetra.set_position (0, 1, 0, 0, 0, 16); sleep(2)
-print("Test walking...")
-tetra.run(2); sleep(3)
-print("Standing position...")
-tetra.run(5); sleep(3)
-print("Turn right...")
-tetra.run(9); sleep(6)
-print("Stop")
-tetra.run(5); sleep(3)
-print("Walk backwards...")
-tetra.run(8); sleep(4)
-print("Turn right again...")
-tetra.run(9); sleep(6)
-print("Standing position...")
-tetra.run(5); sleep(3)
-print("Walk again...")
-tetra.run(2); sleep(3)
-print("Standing position.")
-tetra.run(5); sleep(3)
+walk = Timeline()
+walk.run(0, 5)
+walk.position(0, 0, 240, speed = 0)    # Move leg
+walk.position(2, 0, 16, speed = 0)
+walk.run(4, 2)              # Test walking
+walk.run(7, 5)              # Standing position
+walk.run(10, 9)             # Turn right
+walk.run(16, 5)             # Stop
+walk.run(19, 8)             # Walk backwards
+walk.run(23, 9)             # Turn right again
+walk.run(29, 5)             # Standing position
+walk.run(32, 2)             # Walk again
+walk.run(35, 5)             # Standing position
+tetra.play(walk)
+sleep(3)
 print("The end.")
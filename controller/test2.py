@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from robot import Robot
+from behaviour import Behaviour, sensor
 from gevent import sleep
 
 tetra = Robot('tetra3')
@@ -9,8 +10,7 @@ sleep(0)
 tetra.load_config()
 
 # Load programs
-for i in range(12):
-    tetra.load(i+1)
+tetra.load_all(12)
 tetra.upload_programs()
 sleep(3)
 
@@ -21,33 +21,17 @@ TURN_RIGHT = 6
 
 print("Searching for light...")
 threshold = 1
-program = STANDING
+eyes = sensor(0) - sensor(1)
+behaviour = Behaviour(tetra, rate = 20)
+behaviour.when(eyes > threshold, TURN_RIGHT, "Turn right")
+behaviour.when(eyes < -threshold, TURN_LEFT, "Turn left")
+behaviour.when(abs(eyes) < threshold, GO_FORWARD, "Go forward")
+behaviour.otherwise(STANDING, "Rest a bit")     # When abs(diff) == threshold
+behaviour.start()
 try:
     while True:
-        eyes = tetra.get_sensors()
-        sleep(0.3)
-        diff = eyes[0] - eyes[1]
-        print(diff)
-
-        if diff > threshold:
-            print("Turn right")
-            program = TURN_RIGHT
-        elif diff < -threshold:
-            print("Turn left")
-            program = TURN_LEFT
-        elif abs(diff) < threshold:
-            print("Go forward")
-            program = GO_FORWARD
-        else:		# When abs(diff) == threshold
-            print("Rest a bit")
-            if program == STANDING:
-                sleep(2)
-                continue
-            program = STANDING
-
-        tetra.run(program)
-        sleep(2)
-except Exception as e:
+        sleep(1)
+except (Exception, KeyboardInterrupt) as e:
     print("Stopping...", e)
-    tetra.run(5)
+    behaviour.stop(STANDING)
     sleep(2)
@@ -20,8 +20,7 @@ tetra.ticks_per_step = 10
 tetra.setup_channel('E', active = False)
 tetra.setup_channel('S', active = False)
 tetra.setup_channel('D', active = False)
-for i in range(9):  # Load programs
-    tetra.load(i+1)
+tetra.load_all(9)  # Load programs
 tetra.upload_programs()
 sleep(10)
 tetra.run(5)
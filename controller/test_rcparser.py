@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Tests of the parser of program source code (rcparser.py), and of the code compiled from it
+
+import os
+import glob
+import unittest
+import yaml
+from rcparser import parse, ProgramSyntaxError
+from program import RobotProgram
+
+CHANNELS = ['Q', 'W', 'E', 'A', 'S', 'D', 'R', 'T', 'Y', 'F', 'G', 'H']
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestRCParser (unittest.TestCase):
+
+	def _raw_code (self, source, program = 1):
+		robot_program = RobotProgram('test', CHANNELS)
+		robot_program.set_program_source_code(program, source)
+		return robot_program.get_program_raw_code(program, {i: i for i in range(len(CHANNELS))})
+
+	def _syntax_error (self, source):
+		with self.assertRaises(ProgramSyntaxError) as raised:
+			parse(source, 1, CHANNELS)
+		return raised.exception
+
+	def test_shipped_programs (self):
+		with open(os.path.join(HERE, 'test_rcparser.yaml'), 'r') as f:
+			expected = yaml.safe_load(f)
+		sources = sorted(glob.glob(os.path.join(HERE, '*.rc')))
+		self.assertEqual(sorted(expected), [os.path.basename(path) for path in sources])
+		for path in sources:
+			with open(path, 'r') as f:
+				source = f.read()
+			with self.subTest(program = os.path.basename(path)):
+				self.assertEqual(bytes(self._raw_code(source)).hex(), expected[os.path.basename(path)])
+
+	def test_error_position (self):
+		error = self._syntax_error("Q10 W20\nsleep40\n")
+		self.assertEqual((error.line, error.column, error.token), (2, 6, 'sleep40'))
+		error = self._syntax_error("Q10\n\n  # comment\n\tW20 Z30\n")
+		self.assertEqual((error.line, error.column, error.token), (4, 6, 'Z30'))
+		error = self._syntax_error("Q10 W300\n")
+		self.assertEqual((error.line, error.column), (1, 6))
+		error = self._syntax_error("Q10s17\n")
+		self.assertEqual((error.line, error.column), (1, 5))
+		error = self._syntax_error("Q10m5\n")
+		self.assertEqual((error.line, error.column), (1, 5))
+		error = self._syntax_error("Q10 foo\n")
+		self.assertEqual((error.line, error.column, error.token), (1, 5, 'foo'))
+
+	def test_speed_and_mode_order (self):
+		for source in ("Q10s3m2\n", "Q10m2s3\n", "q10M2S3\n"):
+			code = parse(source, 1, CHANNELS)
+			command = code.commands[0]
+			self.assertEqual((code.count, command['speed'], command['mode'], command['value']), (1, 2, 1, 10))
+		self.assertEqual(parse("Q10s16\n", 1, CHANNELS).commands[0]['speed'], 15)
+		self.assertEqual(parse("Q10m4\n", 1, CHANNELS).commands[0]['mode'], 3)
+		self.assertEqual(self._raw_code("Q10s3m2\n"), self._raw_code("Q10m2s3\n"))
+
+	def test_limits (self):
+		self.assertEqual(self._raw_code("sleep1\n"), [253, 0, 255])
+		self.assertEqual(self._raw_code("sleep32\n"), [253, 31, 255])
+		self.assertEqual(self._raw_code("jump-16\n"), [253, 64, 255])
+		self.assertEqual(self._raw_code("jump15\n"), [253, 63, 255])
+		self.assertEqual(self._raw_code("run0\n"), [254, 0, 255])
+		self.assertEqual(self._raw_code("run255\n"), [254, 255, 255])
+		for source, column in (("sleep0\n", 6), ("sleep33\n", 6), ("jump-17\n", 5), ("jump16\n", 5), ("run256\n", 4),
+				("run-1\n", 4)):
+			with self.subTest(source = source):
+				self.assertEqual(self._syntax_error(source).column, column)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,49 @@
+# This module describes sequences of commands for a robot at given times, to be played by Robot.play()
+
+
+class Timeline(object):
+	"""
+		Commands for a robot at times given in seconds since the timeline starts, i.e.:
+			Timeline().run(0, 2).run(3.0, 5).pose(5.2, {'Q': 240, 'W': 16})
+		Every command is (time, label, action), where action(robot, sent) gives it to the robot, with an
+		AsyncResult set to the time it's written
+	"""
+
+	def __init__ (self):
+		self.commands = []
+
+	def __len__ (self):
+		return len(self.commands)
+
+	def duration (self):
+		return max([at for at, _, _ in self.commands] or [0.0])
+
+	def add (self, at, label, action):
+		if at < 0:
+			raise ValueError("Commands can't be given before the timeline starts")
+		self.commands.append((float(at), label, action))
+		# Commands given for the same time keep their order
+		self.commands.sort(key = lambda command: command[0])
+		return self
+
+	def run (self, at, program):
+		return self.add(at, 'run %d' % program, lambda robot, sent: robot.run(program, sent))
+
+	def stop (self, at):
+		return self.add(at, 'stop', lambda robot, sent: robot.run(0, sent))
+
+	def position (self, at, channel, pos, speed = 15):
+		return self.pose(at, {channel: pos}, speed)
+
+	def pose (self, at, positions, speed = 15):
+		"""
+			Moves the channels given, as {channel: position (0-255)}, at the same time. The disabled ones are left
+			out, and the pose is not sent if all are
+		"""
+		positions = dict(positions)
+		def action (robot, sent):
+			active = {channel: pos for channel, pos in positions.items() if robot.is_active(channel)}
+			for channel, pos in (active or positions).items():
+				robot.set_position(0, 0, channel, speed, 0, pos, sent)
+		label = 'pose ' + ' '.join('%s=%d' % (channel, pos) for channel, pos in positions.items())
+		return self.add(at, label, action)
@@ -0,0 +1,208 @@
+# This module opens the link with a robot from its URL, hiding the library used for it
+
+import fcntl
+import socket
+import termios
+import threading
+from urllib.parse import urlsplit, parse_qs
+from protocol import BAUD_RATE
+
+"""
+   Supported URLs:
+   - serial:///dev/ttyUSB0?baud=57600 (or just /dev/ttyUSB0), with pyserial
+   - tcp://host:port, for ser2net-like bridges and remote robots
+   - bt://98:D3:31:B0:94:55/1, RFCOMM channel (1 by default) of a Bluetooth module, with Linux sockets
+   - loop://?speed=1.0, an emulated robot running in this process
+   - unix:///tmp/leggedbot.sock, a robot shared by daemon.py
+   - replay://session.cap?speed=1.0, a robot answering as recorded in a capture (capture.py)
+"""
+
+class Transport(object):
+	"""
+		Link with a robot, offering the part of the pyserial interface used by the connections:
+		write(), read() without blocking, in_waiting, fileno(), reset_input_buffer(), flush(), close() and is_open
+	"""
+
+	url = None
+
+	def write (self, data):
+		raise NotImplementedError
+
+	def read (self, size = 1):
+		"""
+			Returns up to `size` bytes already received, without waiting
+		"""
+		raise NotImplementedError
+
+	@property
+	def in_waiting (self):
+		raise NotImplementedError
+
+	@property
+	def is_open (self):
+		raise NotImplementedError
+
+	def fileno (self):
+		raise NotImplementedError
+
+	def reset_input_buffer (self):
+		while self.in_waiting:
+			self.read(self.in_waiting)
+
+	def flush (self):
+		pass
+
+	def close (self):
+		raise NotImplementedError
+
+
+class SerialTransport(Transport):
+
+	def __init__ (self, device, baudrate = BAUD_RATE):
+		import serial       # pyserial is only needed for serial ports
+		self.url = device
+		self._conn = serial.Serial(device, baudrate, timeout = 0)
+
+	def write (self, data):
+		self._conn.write(data)
+
+	def read (self, size = 1):
+		return self._conn.read(size)
+
+	@property
+	def in_waiting (self):
+		return self._conn.in_waiting
+
+	@property
+	def is_open (self):
+		return self._conn.isOpen()
+
+	def fileno (self):
+		return self._conn.fileno()
+
+	def reset_input_buffer (self):
+		self._conn.reset_input_buffer()
+
+	def flush (self):
+		self._conn.flush()
+
+	def close (self):
+		self._conn.close()
+
+
+class SocketTransport(Transport):
+	"""
+		Link over a connected stream socket. Writes go out whole, instead of through the serial driver
+	"""
+
+	def __init__ (self, sock, url = None):
+		self.url = url
+		self._sock = sock
+
+	def write (self, data):
+		self._sock.sendall(data)
+
+	def read (self, size = 1):
+		try:
+			data = self._sock.recv(max(size, 1), socket.MSG_DONTWAIT)
+		except BlockingIOError:
+			return b''
+		if not data:
+			raise IOError("Connection closed by the robot")
+		return data
+
+	@property
+	def in_waiting (self):
+		return int.from_bytes(fcntl.ioctl(self._sock.fileno(), termios.FIONREAD, bytes(4)), 'little')
+
+	@property
+	def is_open (self):
+		return self._sock.fileno() >= 0
+
+	def fileno (self):
+		return self._sock.fileno()
+
+	def close (self):
+		self._sock.close()
+
+
+class TcpTransport(SocketTransport):
+
+	CONNECT_TIMEOUT = 5.0
+
+	def __init__ (self, host, port):
+		sock = socket.create_connection((host, port), self.CONNECT_TIMEOUT)
+		sock.settimeout(None)
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		SocketTransport.__init__(self, sock, 'tcp://%s:%d' % (host, port))
+
+
+class RfcommTransport(SocketTransport):
+
+	def __init__ (self, address, channel = 1):
+		if not hasattr(socket, 'AF_BLUETOOTH'):
+			raise IOError("Bluetooth sockets are not supported by this Python")
+		sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+		try:
+			sock.connect((address, channel))
+		except OSError:
+			sock.close()
+			raise
+		SocketTransport.__init__(self, sock, 'bt://%s/%d' % (address, channel))
+
+
+class UnixTransport(SocketTransport):
+
+	def __init__ (self, path):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.connect(path)
+		except OSError:
+			sock.close()
+			raise
+		SocketTransport.__init__(self, sock, 'unix://' + path)
+
+
+class LoopbackTransport(SocketTransport):
+	"""
+		Link with an emulated robot served from a thread in this process
+	"""
+
+	def __init__ (self, emulator = None, speed = 1.0):
+		from emulator import RobotEmulator, VirtualClock
+		self.emulator = emulator or RobotEmulator(clock = VirtualClock(speed))
+		host, robot = socket.socketpair()
+		threading.Thread(target = self.emulator.serve, args = (robot.detach(), ), daemon = True).start()
+		SocketTransport.__init__(self, host, 'loop://?speed=%s' % self.emulator.clock.speed)
+
+	def close (self):
+		self.emulator.stop()
+		SocketTransport.close(self)
+
+
+def open_transport (url, baudrate = BAUD_RATE, default_scheme = 'serial'):
+	"""
+		Opens the link given by an URL. Without scheme, the URL is taken as a device for the default one
+	"""
+	if isinstance(url, Transport):
+		return url
+	if '://' not in url:
+		url = '%s://%s' % (default_scheme, url)
+	parts = urlsplit(url)
+	query = parse_qs(parts.query)
+	if parts.scheme == 'serial':
+		return SerialTransport(parts.netloc + parts.path, int(query.get('baud', [baudrate])[0]))
+	elif parts.scheme == 'tcp':
+		if not parts.hostname or parts.port is None:
+			raise ValueError("A host and a port are needed, as in tcp://host:port, in " + url)
+		return TcpTransport(parts.hostname, parts.port)
+	elif parts.scheme == 'bt':
+		return RfcommTransport(parts.netloc, int(parts.path.strip('/') or 1))
+	elif parts.scheme == 'unix':
+		return UnixTransport(parts.netloc + parts.path)
+	elif parts.scheme == 'loop':
+		return LoopbackTransport(speed = float(query.get('speed', [1.0])[0]))
+	elif parts.scheme == 'replay':
+		from capture import ReplayTransport
+		return ReplayTransport(parts.netloc + parts.path, float(query.get('speed', [1.0])[0]))
+	raise ValueError("Unknown transport in " + url)
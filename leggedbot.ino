@@ -19,6 +19,13 @@
 #define MEM_FOR_PROGRAMS  1024
 #define MAX_CHANNELS    12    // Max is 12
 
+#define FIRMWARE_FEATURES   3     // Bit 0: uploads with credits, bit 1: telemetry
+#define UPLOAD_CREDIT       6     // Sent to the host every UPLOAD_CREDIT_SIZE bytes read during an upload with credits
+#define UPLOAD_DONE         4     // Sent to the host at the end of an upload with credits
+#define UPLOAD_CREDIT_SIZE  32
+#define TELEMETRY_FRAME     0x80  // Plus the number of analog inputs, starts every telemetry frame
+#define ANALOG_INPUTS       6
+
 #ifdef DEBUG
 #define PERIOD_IN_USECS   50000
 #define MIN_PULSE_WIDTH   5000
@@ -35,6 +42,8 @@ volatile unsigned int program_offset = 0;
 unsigned int ticks_per_step = 6;
 unsigned int total_outputs = MAX_CHANNELS;
 volatile boolean uploading = false;
+boolean upload_credits = false;                   // Grant credits to the host while reading an upload
+unsigned int upload_read = 0;                     // Bytes read in the current upload
 volatile unsigned int step_tick = 0;
 volatile unsigned int activity[MAX_CHANNELS];
 int delta[MAX_CHANNELS] = {0};                    // Keeps delta to add to current_pos until it reaches desired_pos (speed)
@@ -45,6 +54,9 @@ unsigned int inverted_channels = 0;               // Each bit keeps if channel m
 volatile int current_pos[MAX_CHANNELS];           // Keeps the current value for every actuator
 volatile int order[MAX_CHANNELS];                 // Keeps the order of every channel
 volatile long elapsed;                            // Keeps the time elapsed in a pulse
+unsigned char telemetry_mask = 0;                 // Analog inputs pushed to the host (bit 0 being A0, ...)
+unsigned int telemetry_period = 0;                // Milliseconds between telemetry frames
+unsigned long telemetry_next = 0;                 // When the next telemetry frame is due
 
 /// --------------------------------------
 /// Control for program execution
@@ -78,6 +90,32 @@ void runProgramStep ()
   }
 }
 
+/*
+   Wait for a byte from Serial during an upload. If the host asked for credits, tell it every time
+   UPLOAD_CREDIT_SIZE bytes have been taken from the receive buffer, so it can send that many bytes more
+*/
+unsigned char uploadRead ()
+{
+  unsigned char value;
+  while (Serial.available() < 1);
+  value = Serial.read();
+  if (upload_credits && (++upload_read % UPLOAD_CREDIT_SIZE) == 0) {
+    Serial.write(UPLOAD_CREDIT);
+  }
+  return value;
+}
+
+/*
+   Tell the host the upload has ended, if it asked for credits
+*/
+void uploadDone ()
+{
+  if (upload_credits) {
+    Serial.write(UPLOAD_DONE);
+    upload_credits = false;
+  }
+}
+
 /*
    Load configuration from EEPROM or Serial, to RAM or EEPROM
    If `fromSource` = 0, load configuration from EEPROM to RAM
@@ -92,12 +130,10 @@ void loadConfiguration (int fromSource = 0)
 
   // Get configuration length
   if (fromSource) {
-    while (Serial.available() < 1);
     // Get code length (lower byte)
-    length = Serial.read();
+    length = uploadRead();
     // Get code length (high byte)
-    while (Serial.available() < 1);
-    length |= Serial.read() << 8;
+    length |= uploadRead() << 8;
   } else {
     // Get code length (lower byte)
     length = EEPROM[0];
@@ -110,16 +146,14 @@ void loadConfiguration (int fromSource = 0)
   //Serial.println(length);
   // Get total_programs
   if (fromSource) {
-    while (Serial.available() < 1);
-    total_programs = Serial.read();
+    total_programs = uploadRead();
   } else {
     total_programs = EEPROM[2];
   }
 
   // Get ticks_per_step and total_outputs
   if (fromSource) {
-    while (Serial.available() < 1);
-    ticks_per_step = Serial.read();
+    ticks_per_step = uploadRead();
   } else {
     ticks_per_step = EEPROM[3];
   }
@@ -136,9 +170,9 @@ void loadConfiguration (int fromSource = 0)
 
   if (fromSource == 2) {
     for (i = 0; i < 2 + length + (total_outputs << 1); i++) {
-      while (Serial.available() < 1);
-      EEPROM.update(4 + i, (unsigned char)Serial.read());
+      EEPROM.update(4 + i, uploadRead());
     }
+    uploadDone();
     uploading = false;
     digitalWrite(13, 0);
     return;
@@ -147,13 +181,12 @@ void loadConfiguration (int fromSource = 0)
   // Get ranges for every active channel
   for (i = 0; i < total_outputs; i++) {
     if (fromSource) {
-      while (Serial.available() < 2);
 #ifndef DEBUG
-      min_range[i] = map((long)Serial.read(), 0, 255, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
-      max_range[i] = map((long)Serial.read(), 0, 255, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
+      min_range[i] = map((long)uploadRead(), 0, 255, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
+      max_range[i] = map((long)uploadRead(), 0, 255, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
 #else
-      min_range[i] = MIN_PULSE_WIDTH; Serial.read();
-      max_range[i] = MAX_PULSE_WIDTH; Serial.read();
+      min_range[i] = MIN_PULSE_WIDTH; uploadRead();
+      max_range[i] = MAX_PULSE_WIDTH; uploadRead();
 #endif
     } else {
 #ifndef DEBUG
@@ -168,12 +201,10 @@ void loadConfiguration (int fromSource = 0)
 
   // Get array of bits representing which of the channels are inverted (2-byte array of bits)
   if (fromSource) {
-    while (Serial.available() < 1);
     // Get inverted_channels array (lower byte)
-    inverted_channels = Serial.read();
+    inverted_channels = uploadRead();
     // Get inverted_channels array (high byte)
-    while (Serial.available() < 1);
-    inverted_channels |= Serial.read() << 8;
+    inverted_channels |= uploadRead() << 8;
   } else {
     // Get inverted_channels array (lower byte)
     inverted_channels = EEPROM[(total_outputs << 1) + 4];
@@ -183,12 +214,12 @@ void loadConfiguration (int fromSource = 0)
   // Get program offsets and code
   for (i = 0; i < length; i++) {
     if (fromSource) {
-      while (Serial.available() < 1);
-      programs[i] = Serial.read();
+      programs[i] = uploadRead();
     } else {
       programs[i] = EEPROM[i + (total_outputs << 1) + 6];
     }
   }
+  uploadDone();
   digitalWrite(13, 0);
   uploading = false;
 }
@@ -270,6 +301,20 @@ void processCommand (unsigned int cmd, unsigned int pos)
         Serial.write(map(analogRead(i), 0, 1023, 0, 255));
         delayMicroseconds(15000);
       }
+    } else if (pos == 2) {      // Get the features supported by this firmware
+      Serial.write(1);
+      Serial.write(FIRMWARE_FEATURES);
+    } else if (pos == 3) {      // Push analog inputs to the host (mask, period in ms), or stop (mask 0)
+      while (Serial.available() < 2);
+      telemetry_mask = Serial.read() & ((1 << ANALOG_INPUTS) - 1);
+      // max() is a macro that would read twice
+      int period = Serial.read();
+      telemetry_period = max(period, 1);
+      telemetry_next = millis();
+    } else if (pos == 251 || pos == 252) {  // Same as 253 and 255, granting credits to the host
+      upload_credits = true;
+      upload_read = 0;
+      loadConfiguration(pos == 251 ? 2 : 1);
     } else if (pos == 253) {    // Load configuration from Serial to EEPROM
       loadConfiguration(2);
     } else if (pos == 254) {    // Load configuration from EEPROM to RAM
@@ -511,6 +556,27 @@ void setup()
 
 }
 
+/*
+   Send the analog inputs in the telemetry mask, with the time they were read
+*/
+void sendTelemetry ()
+{
+  unsigned int now = millis();
+  int count = 0;
+  for (int i = 0; i < ANALOG_INPUTS; i++) {
+    count += (telemetry_mask >> i) & 1;
+  }
+  Serial.write(TELEMETRY_FRAME | count);
+  Serial.write(now & 255);
+  Serial.write(now >> 8);
+  for (int i = 0; i < ANALOG_INPUTS; i++) {
+    if (telemetry_mask & (1 << i)) {
+      analogRead(i);    // Let the ADC settle after switching the input, instead of waiting 15 ms
+      Serial.write(map(analogRead(i), 0, 1023, 0, 255));
+    }
+  }
+}
+
 /// --------------------------------------
 /// Main loop. Just waiting for commands
 /// --------------------------------------
@@ -524,6 +590,12 @@ void loop() {
   processNunchuckKeys();
 #endif
 
+  if (telemetry_mask && (long)(millis() - telemetry_next) >= 0) {
+    // Skip the frames missed while busy, so they don't come in a burst
+    telemetry_next += telemetry_period * ((millis() - telemetry_next) / telemetry_period + 1);
+    sendTelemetry();
+  }
+
   // Wait for two bytes to process the command
   if (Serial.available() >= 2) {
     // read the incoming byte: